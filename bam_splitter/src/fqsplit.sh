@@ -6,7 +6,7 @@ VERSION=1.0
 #author		 :Jan Hapala <jan@hapala.cz>
 #date            :20200904
 #usage		 :./fqsplit.sh -i PATH_TO_BAM -1 PATH_TO_FASTQ_R1 -2 PATH_TO_FASTQ_R2 [ -d OUTPUT_DIR ]
-#notes           :Install samtools and python3 to use this script.
+#notes           :Install samtools and python3 to use this script (samtools is not needed with -N).
 #bash		 :GNU bash, version 5.0.17(1)-release
 #==============================================================================
 
@@ -27,15 +27,28 @@ INPUT_BAM=""
 OUTPUT_DIR="./"
 NR_LINES_PRINT=1000000
 DB_FILENAME=".fastqslitter.db"
-RECORDS_IN_BUFFER=10000000
+MEMORY_BUDGET="4G"
 RECORDS_IN_BUFFER_FASTQ=1000
 CALC_STATS=0
 DO_NOT_DELETE_DB=0
+BACKEND="sqlite"
+COMPRESSION_THREADS=1
+COMPRESSION_LEVEL=9
+NATIVE_BAM=0
+PARTITIONS=1
 DELETE_DB=0
+SINGLE_PROCESS=0
+BGZF_OUTPUT=""
+THRESHOLD=0.75
+JOBS=""
+MMAP_INDEX=""
+BLOOM_FILTER=""
+SAMPLES=""
+SKIP_UNASSIGNED=""
 
 
 ## process arguments
-while getopts "b:d:1:2:hsvxX" opt; do
+while getopts "b:d:1:2:j:k:l:M:P:t:T:BcfhImNRSsuvxX" opt; do
   case ${opt} in
     d )
       OUTPUT_DIR=${OPTARG}
@@ -44,10 +57,58 @@ while getopts "b:d:1:2:hsvxX" opt; do
       INPUT_BAM=${OPTARG}
       ;;
     1 )
-      INPUT_FASTQ_R1=${OPTARG}
+      INPUT_FASTQ_R1="${INPUT_FASTQ_R1} ${OPTARG}"
       ;;
     2 )
-      INPUT_FASTQ_R2=${OPTARG}
+      INPUT_FASTQ_R2="${INPUT_FASTQ_R2} ${OPTARG}"
+      ;;
+    j )
+      JOBS="-j ${OPTARG}"
+      ;;
+    B )
+      BGZF_OUTPUT="--bgzf"
+      ;;
+    c )
+      BACKEND="sqlite-compact"
+      ;;
+    I )
+      MMAP_INDEX="--mmap-index"
+      ;;
+    f )
+      BLOOM_FILTER="--bloom"
+      ;;
+    k )
+      SAMPLES="--samples ${OPTARG}"
+      ;;
+    u )
+      SKIP_UNASSIGNED="--skip-unassigned"
+      ;;
+    m )
+      BACKEND="memory"
+      ;;
+    N )
+      NATIVE_BAM=1
+      ;;
+    R )
+      BACKEND="sorted"
+      ;;
+    S )
+      SINGLE_PROCESS=1
+      ;;
+    M )
+      MEMORY_BUDGET=${OPTARG}
+      ;;
+    P )
+      PARTITIONS=${OPTARG}
+      ;;
+    t )
+      COMPRESSION_THREADS=${OPTARG}
+      ;;
+    l )
+      COMPRESSION_LEVEL=${OPTARG}
+      ;;
+    T )
+      THRESHOLD=${OPTARG}
       ;;
     s )
       export CALC_STATS=1
@@ -63,6 +124,23 @@ while getopts "b:d:1:2:hsvxX" opt; do
       echo ""
       echo "Optional arguments:"
       echo "-d		output directory"
+      echo "-1, -2		reads1 and reads2 FASTQ files; repeat both for several lanes, in the same order"
+      echo "-j		number of processes splitting the lanes in parallel (default: one per lane, at most one per CPU; not with -S)"
+      echo "-B		(no argument) Write BGZF output files with a read index (FILE.idx)."
+      echo "-c		(no argument) Use the compact, integer-keyed database schema."
+      echo "-f		(no argument) Screen the reads with a Bloom filter before looking them up."
+      echo "-I		(no argument) Export the read association into a memory-mapped index used for splitting."
+      echo "-m		(no argument) Keep the read information in memory instead of an SQLite database."
+      echo "-N		(no argument) Read the BAM file directly, without samtools and mawk."
+      echo "-R		(no argument) Keep the read information in sorted run files merged on disk (for the largest inputs)."
+      echo "-S		(no argument) Build, process and split in a single process (fastest with -m)."
+      echo "-M		memory budget for the alignments buffered while building the database, e.g. 512M, 4G (default: 4G)"
+      echo "-P		number of database partitions processed in parallel (default: 1)"
+      echo "-t		number of threads (de)compressing the BAM and the output files (default: 1)"
+      echo "-k		comma-separated sample tags to keep, the reads of the other samples and UNDETERMINED are not written"
+      echo "-u		(no argument) Do not write the UNDETERMINED and MULTIPLE reads."
+      echo "-l		gzip compression level of the output files, 1-9 (default: 9)"
+      echo "-T		minimum share of the reads of a cell with the dominant sample tag (default: 0.75)"
       echo "-s		(no argument) Print reads statistics."
       echo "-x		(no argument) Do not delete temporary database."
       echo ""
@@ -113,12 +191,22 @@ if [ ! -f "$INPUT_BAM" ]; then
     echo "The input file $INPUT_BAM does not exist."
     exit 1
 fi
-if [ ! -f "$INPUT_FASTQ_R1" ]; then
-    echo "The input file $INPUT_FASTQ_R1 does not exist."
+if [[ -z $INPUT_FASTQ_R1 || -z $INPUT_FASTQ_R2 ]]; then
+    echo "INPUT_FASTQ_R1 or INPUT_FASTQ_R2 argument is missing."
     exit 1
 fi
-if [ ! -f "$INPUT_FASTQ_R2" ]; then
-    echo "The input file $INPUT_FASTQ_R2 does not exist."
+for INPUT_FASTQ in ${INPUT_FASTQ_R1} ${INPUT_FASTQ_R2}; do
+    if [ ! -f "$INPUT_FASTQ" ]; then
+        echo "The input file $INPUT_FASTQ does not exist."
+        exit 1
+    fi
+done
+if [ `echo ${INPUT_FASTQ_R1} | wc -w` -ne `echo ${INPUT_FASTQ_R2} | wc -w` ]; then
+    echo "Every reads1 FASTQ file needs its reads2 FASTQ file."
+    exit 1
+fi
+if [[ $SINGLE_PROCESS -gt 0 && -n $JOBS ]]; then
+    echo "-j cannot be used with -S, the single process splits the lanes one after another."
     exit 1
 fi
 
@@ -155,19 +243,45 @@ echo "OUTPUT DIRECTORY: ${OUTPUT_DIR}"
 echo "-------------------------------------------------------------------------------------------"
 echo ""
 
+if [ $SINGLE_PROCESS -gt 0 ]; then
+	echo `timestamp`"    Collecting information about the reads and splitting the files in a single process..."
+	OPT_PARAMS=""
+	if [ $CALC_STATS -gt 0 ]; then OPT_PARAMS="${OPT_PARAMS} --stats"; fi
+	if [ $DO_NOT_DELETE_DB -gt 0 ]; then OPT_PARAMS="${OPT_PARAMS} --no-del"; fi
+	SPLIT_PARAMS="-1 ${INPUT_FASTQ_R1} -2 ${INPUT_FASTQ_R2} -d ${OUTPUT_DIR} -F ${RECORDS_IN_BUFFER_FASTQ} --mem ${MEMORY_BUDGET} \
+		--backend ${BACKEND} --partitions ${PARTITIONS} -t ${COMPRESSION_THREADS} -l ${COMPRESSION_LEVEL} ${BGZF_OUTPUT} \
+		--threshold ${THRESHOLD} ${MMAP_INDEX} ${BLOOM_FILTER} ${SAMPLES} ${SKIP_UNASSIGNED} ${OPT_PARAMS}"
+	if [ $NATIVE_BAM -gt 0 ]; then
+		${WORK_DIR}/main.py split ${DB_FILENAME} -b ${INPUT_BAM} ${SPLIT_PARAMS}
+	else
+		samtools view ${INPUT_BAM} | grep ".*CN:Z:T.*" | mawk -f ${WORK_DIR}/extract_fields.mawk | \
+			${WORK_DIR}/main.py split ${DB_FILENAME} ${SPLIT_PARAMS}
+	fi
+	if [ $? -ne 0 ]; then echo "ERROR. Terminating."; cleanup; exit 1; fi
+	echo "                       Size of the output dir: " `du -sh ${OUTPUT_DIR} | cut -f1`
+	echo `timestamp`"    DONE"
+	cleanup
+	exit 0
+fi
+
 echo `timestamp`"    Collecting information about the reads..."
 
 ### go through the BAM file and pass down reads from genuine cells (CN tag T[rue])
 ###  and extract read_id, cell_id and sample_name
-samtools view ${INPUT_BAM} | grep ".*CN:Z:T.*" | mawk -f ${WORK_DIR}/extract_fields.mawk | \
-		${WORK_DIR}/main.py -d ${OUTPUT_DIR} build ${DB_FILENAME} -f ${RECORDS_IN_BUFFER}
+if [ $NATIVE_BAM -gt 0 ]; then
+	${WORK_DIR}/main.py -d ${OUTPUT_DIR} build ${DB_FILENAME} -b ${INPUT_BAM} --mem ${MEMORY_BUDGET} \
+		--backend ${BACKEND} --partitions ${PARTITIONS} -t ${COMPRESSION_THREADS}
+else
+	samtools view ${INPUT_BAM} | grep ".*CN:Z:T.*" | mawk -f ${WORK_DIR}/extract_fields.mawk | \
+		${WORK_DIR}/main.py -d ${OUTPUT_DIR} build ${DB_FILENAME} --mem ${MEMORY_BUDGET} --backend ${BACKEND} --partitions ${PARTITIONS}
+fi
 echo "                       Size of the output dir: " `du -sh ${OUTPUT_DIR} | cut -f1`
 if [ $? -ne 0 ]; then echo "ERROR. Terminating."; cleanup; exit 1; fi
 
 echo `timestamp`"    Processing the DB - deciding on the sample partitioning..."
 OPT_PARAMS=""
 if [ $CALC_STATS -gt 0 ]; then OPT_PARAMS="--stats"; fi
-RUN_CMD="${WORK_DIR}/main.py -d ${OUTPUT_DIR} process ${DB_FILENAME} ${OPT_PARAMS}"
+RUN_CMD="${WORK_DIR}/main.py -d ${OUTPUT_DIR} process ${DB_FILENAME} --backend ${BACKEND} --partitions ${PARTITIONS} --threshold ${THRESHOLD} ${MMAP_INDEX} ${BLOOM_FILTER} ${SAMPLES} ${OPT_PARAMS}"
 eval ${RUN_CMD}
 echo "                       Size of the output dir: " `du -sh ${OUTPUT_DIR} | cut -f1`
 if [ $? -ne 0 ]; then echo "ERROR. Terminating."; cleanup; exit 1; fi
@@ -176,7 +290,8 @@ echo `timestamp`"    Splitting the file..."
 OPT_PARAMS=""
 if [ $DO_NOT_DELETE_DB -gt 0 ]; then OPT_PARAMS="--no-del"; fi
 ${WORK_DIR}/main.py -1 ${INPUT_FASTQ_R1} -2 ${INPUT_FASTQ_R2} -d ${OUTPUT_DIR} "retrieve" \
-	${DB_FILENAME} -F ${RECORDS_IN_BUFFER_FASTQ} ${OPT_PARAMS}
+	${DB_FILENAME} -F ${RECORDS_IN_BUFFER_FASTQ} --backend ${BACKEND} --partitions ${PARTITIONS} \
+	-t ${COMPRESSION_THREADS} -l ${COMPRESSION_LEVEL} ${BGZF_OUTPUT} ${JOBS} ${MMAP_INDEX} ${BLOOM_FILTER} ${SKIP_UNASSIGNED} ${OPT_PARAMS}
 echo "                       Size of the output dir: " `du -sh ${OUTPUT_DIR} | cut -f1`
 
 echo `timestamp`"    DONE"
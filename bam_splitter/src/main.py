@@ -10,23 +10,49 @@ __status__ = "Production"
 import sys
 import argparse
 from pybamsplit.read_processor import ReadProcessor
+from pybamsplit.read_storage import STORAGE_BACKENDS
+from pybamsplit.compression import COMPRESSION_LEVEL
+from pybamsplit.prefetch import QUEUE_DEPTH
+from pybamsplit.batch_writer import parse_size
+from pybamsplit.output_manager import MAX_OPEN_FILES
+from pybamsplit.instrumentation import run_profiled
+from pybamsplit.bloom import FALSE_POSITIVE_RATE
 
-RECORDS_IN_BUFFER = 10000000 # ~ 2.7GB RAM
+MEMORY_BUDGET = "4G"
 RECORDS_IN_BUFFER_FASTQ = 100000
 minimumSampleAssociationThreshold = 0.75
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('cmd', help='command to execute', choices=['build', 'process', 'retrieve'])
+    parser.add_argument('cmd', help='command to execute; split runs build, process and retrieve in one process', choices=['build', 'process', 'retrieve', 'split'])
     parser.add_argument('db_file', help='path to the database filename')
     parser.add_argument('-d', help='path to the output directory')
-    parser.add_argument('-1', help='path to reads1 fastq file')
-    parser.add_argument('-2', help='path to reads2 fastq file')
-    parser.add_argument('-f', help='buffer size in number of alignments from the BAM files that are collected before writing to the database')
+    parser.add_argument('-b', help='path to the input BAM file (build); if not given, the fields extracted by extract_fields.mawk are read from the standard input')
+    parser.add_argument('-1', nargs='+', help='path(s) to reads1 fastq file(s), one per lane')
+    parser.add_argument('-2', nargs='+', help='path(s) to reads2 fastq file(s), in the same lane order')
+    parser.add_argument('-j', '--jobs', type=int, help='number of worker processes splitting the lane pairs in parallel (retrieve), default: one per lane, at most one per CPU')
+    parser.add_argument('-f', help='optional limit of the buffer size in number of alignments from the BAM files that are collected before writing to the database')
+    parser.add_argument('--mem', default=MEMORY_BUDGET, help=f'memory budget (e.g. 512M, 4G) for the alignments collected before writing to the database, default: {MEMORY_BUDGET}')
     parser.add_argument('-F', help='buffer size in number of FASTQ reads loaded before looking up in the database and writing to the output files')
-    parser.add_argument('--stats', help='print statistics on the processed reads, it can slow down the computation by hours in case of big input files', action="store_true")
+    parser.add_argument('--threshold', type=float, default=minimumSampleAssociationThreshold, help=f'minimum share of the reads of a cell carrying the dominant sample tag, otherwise the cell is MULTIPLE (process, split), default: {minimumSampleAssociationThreshold}; process can be run again with a new threshold until retrieve')
+    parser.add_argument('--sweep', help='comma-separated thresholds (e.g. 0.5,0.6,0.75,0.9) at which process reports the cell count per sample and MULTIPLE')
+    parser.add_argument('--stats', help='print the cell count per sample; the statistics of every command are saved to fqsplit_stats.json in the output directory regardless of this option', action="store_true")
     parser.add_argument('--no-del', dest="no_del", help='do not delete the database file after finishing', action="store_true")
+    parser.add_argument('-t', '--threads', type=int, default=1, help='number of threads decompressing the input BAM file (build) or compressing the output FASTQ files (retrieve)')
+    parser.add_argument('-l', '--level', type=int, default=COMPRESSION_LEVEL, choices=range(1, 10), metavar='{1..9}', help='gzip compression level of the output FASTQ files')
+    parser.add_argument('--partitions', type=int, default=1, help='number of partition databases the reads are split into, the process command handles them in parallel; use the same value for all the commands')
+    parser.add_argument('--flush-size', dest="flush_size", default="8M", help='size of the reads buffered per sample before they are written to the output files (e.g. 8M)')
+    parser.add_argument('--max-open-files', dest="max_open_files", type=int, default=MAX_OPEN_FILES, help='maximum number of output files open at once, the least recently used are closed and appended to later')
+    parser.add_argument('--prefetch', type=int, default=QUEUE_DEPTH, help='number of decompressed 4MB chunks of each input FASTQ file read ahead on a background thread')
+    parser.add_argument('--backend', help='storage of the read information: SQLite database, SQLite database with the compact integer-keyed schema, in-memory hash maps (for inputs fitting in RAM) or sorted run files merged on disk with sequential I/O only (for inputs outgrowing the memory and the SQLite indexes); use the same value for all the commands', choices=list(STORAGE_BACKENDS), default='sqlite')
+    parser.add_argument('--bgzf', action="store_true", help='write the output FASTQ files as BGZF blocks starting with whole reads, with an index of the block offsets and read numbers (FILE.idx) for parallel decompression')
+    parser.add_argument('--mmap-index', dest="mmap_index", action="store_true", help='process exports the read -- cell association into a compact sorted index file (DB_FILE.mmidx), which retrieve memory-maps and searches instead of querying the database; use the option with both commands (requires numpy)')
+    parser.add_argument('--bloom', action="store_true", help='process writes a Bloom filter of the associated read IDs (DB_FILE.bloom), retrieve screens every batch with it and sends the certain misses to UNDETERMINED without looking them up; use the option with both commands (requires numpy)')
+    parser.add_argument('--bloom-fp-rate', dest="bloom_fp_rate", type=float, default=FALSE_POSITIVE_RATE, help=f'false-positive rate the Bloom filter is sized for (process), default: {FALSE_POSITIVE_RATE}')
+    parser.add_argument('--samples', help='comma-separated sample tags (MULTIPLE included if listed) whose reads are written; process keeps only the reads of the cells assigned to them in the association (SQLite backends, such a database cannot be processed again) and retrieve reuses the selection of process unless given; UNDETERMINED is not written with a selection')
+    parser.add_argument('--skip-unassigned', dest="skip_unassigned", action="store_true", help='do not write the UNDETERMINED and MULTIPLE reads (retrieve, split)')
+    parser.add_argument('--profile', help='run the command under cProfile and save the statistics to this file for offline analysis (python3 -m pstats FILE); only the main thread is profiled')
     args = parser.parse_args()
     args = args.__dict__
     cmd = args["cmd"]
@@ -36,26 +62,58 @@ if __name__ == "__main__":
     fastq_buffer_size = args["F"]
     calc_stats = args["stats"]
     do_not_delete_db = args["no_del"]
+    backend = args["backend"]
+    compression_threads = args["threads"]
+    compression_level = args["level"]
+    prefetch_depth = args["prefetch"]
+    partitions = args["partitions"]
+    flush_size = parse_size(args["flush_size"])
+    max_open_files = args["max_open_files"]
+    blocked_output = args["bgzf"]
+    threshold = args["threshold"]
+    mmap_index = args["mmap_index"]
+    bloom = args["bloom"]
+    bloom_fp_rate = args["bloom_fp_rate"]
+    samples = [sample.strip() for sample in args["samples"].split(",") if sample.strip()] if args["samples"] else None
+    skip_unassigned = args["skip_unassigned"]
+    sweep = [float(value) for value in args["sweep"].split(",")] if args["sweep"] else None
     
     if alignment_buffer_size is None or int(alignment_buffer_size) < 0:
-        alignment_buffer_size = RECORDS_IN_BUFFER
+        alignment_buffer_size = None
     else:
         alignment_buffer_size = int(alignment_buffer_size)
+    memory_budget = parse_size(args["mem"])
     if fastq_buffer_size is None or int(fastq_buffer_size) < 0:
         fastq_buffer_size = RECORDS_IN_BUFFER_FASTQ
     else:
         fastq_buffer_size = int(fastq_buffer_size)
 
 
-    read_processor = ReadProcessor(out_dir, db_file, minimumSampleAssociationThreshold)
+    read_processor = ReadProcessor(out_dir, db_file, threshold=threshold, backend=backend,
+                                   compression_threads=compression_threads, compression_level=compression_level,
+                                   prefetch_depth=prefetch_depth, partitions=partitions,
+                                   flush_size=flush_size, max_open_files=max_open_files,
+                                   blocked_output=blocked_output, mmap_index=mmap_index,
+                                   bloom=bloom, bloom_fp_rate=bloom_fp_rate,
+                                   samples=samples, skip_unassigned=skip_unassigned)
 
     if cmd == "build":
-        read_processor.read_and_store(alignment_buffer_size)
+        command, command_args = read_processor.read_and_store, (alignment_buffer_size, args["b"], compression_threads, memory_budget)
     elif cmd == "process":
-        read_processor.process_db(calc_stats)
+        command, command_args = read_processor.process_db, (calc_stats, sweep)
     elif cmd == "retrieve":
-        read_processor.retrieve(args["1"], args["2"], fastq_buffer_size, do_not_delete_db)
+        command, command_args = read_processor.retrieve, (args["1"], args["2"], fastq_buffer_size, do_not_delete_db,
+                                                          args["jobs"])
+    elif cmd == "split":
+        command, command_args = read_processor.split, (args["1"], args["2"], fastq_buffer_size, alignment_buffer_size,
+                                                       args["b"], compression_threads, memory_budget, calc_stats,
+                                                       do_not_delete_db)
     else:
         raise Exception("ERROR: unknown command provided: ", cmd)
 
+    if args["profile"] is None:
+        command(*command_args)
+    else:
+        run_profiled(command, args["profile"], *command_args)
+
 
@@ -0,0 +1,190 @@
+"""bam_reader.py: reads the read names and the cell/sample tags directly from a BAM file"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+RAW_READ_SIZE = 16 * 1024 * 1024
+BATCHES_AHEAD = 2
+
+BGZF_HEADER = struct.Struct("<4BI2BH")
+BAM_RECORD_HEADER = struct.Struct("<iiBBHHHi")
+INT32 = struct.Struct("<i")
+
+## sizes of the fixed-size values of the BAM auxiliary fields
+AUX_VALUE_SIZES = {ord(t): s for t, s in (("A", 1), ("c", 1), ("C", 1), ("s", 2), ("S", 2),
+                                          ("i", 4), ("I", 4), ("f", 4))}
+AUX_STRING_TYPES = (ord("Z"), ord("H"))
+AUX_ARRAY_TYPE = ord("B")
+
+CELL_TAG = b"CB"
+SAMPLE_TAG = b"ST"
+PUTATIVE_CELL_TAG = b"CN"
+## the record can pass the CN:Z:T filter only if this occurs in its auxiliary data
+PUTATIVE_CELL_PATTERN = b"CNZT"
+
+
+class BamFormatException(Exception):
+    pass
+
+
+def inflate_block(cdata, isize):
+    """Decompress the raw deflate data of one BGZF block"""
+    data = zlib.decompress(cdata, -zlib.MAX_WBITS, isize if isize > 0 else zlib.DEF_BUF_SIZE)
+    if len(data) != isize:
+        raise BamFormatException("BGZF block size does not match its contents.")
+    return(data)
+
+
+def split_bgzf_blocks(raw):
+    """Find the complete BGZF blocks in the raw buffer;
+        return their (compressed data, uncompressed size) and the number of bytes they take.
+    """
+    blocks = []
+    view = memoryview(raw)
+    pos = 0
+    while pos + BGZF_HEADER.size <= len(raw):
+        id1, id2, cm, flg, mtime, xfl, os_, xlen = BGZF_HEADER.unpack_from(raw, pos)
+        if id1 != 31 or id2 != 139 or cm != 8 or not flg & 4:
+            raise BamFormatException("The input is not a BGZF compressed BAM file.")
+        extra_end = pos + BGZF_HEADER.size + xlen
+        if extra_end > len(raw):
+            break
+        block_size = None
+        sub = pos + BGZF_HEADER.size
+        while sub + 4 <= extra_end:
+            slen = raw[sub + 2] | raw[sub + 3] << 8
+            if raw[sub:sub + 2] == b"BC" and slen == 2:
+                block_size = (raw[sub + 4] | raw[sub + 5] << 8) + 1
+            sub += 4 + slen
+        if block_size is None:
+            raise BamFormatException("BGZF block without the BC field.")
+        if pos + block_size > len(raw):
+            break
+        isize = INT32.unpack_from(raw, pos + block_size - 4)[0]
+        blocks.append((view[extra_end:pos + block_size - 8], isize))
+        pos += block_size
+    return(blocks, pos)
+
+
+class BamReader:
+    """Decompresses the BGZF blocks of a BAM file on a thread pool
+        and parses the binary alignment records.
+    """
+
+    file_name = None
+    threads = 1
+
+    def __init__(self, file_name, threads=1):
+        self.file_name = file_name
+        self.threads = max(1, threads)
+
+    def chunks(self):
+        """Yield the decompressed data, a batch of BGZF blocks at a time"""
+        pending = deque()
+        rest = b""
+        with open(self.file_name, "rb") as f, ThreadPoolExecutor(max_workers=self.threads) as executor:
+            while True:
+                raw = f.read(RAW_READ_SIZE)
+                if not raw:
+                    break
+                raw = rest + raw if rest else raw
+                blocks, end = split_bgzf_blocks(raw)
+                rest = raw[end:]
+                pending.append([executor.submit(inflate_block, cdata, isize) for cdata, isize in blocks])
+                while len(pending) > BATCHES_AHEAD:
+                    yield(b"".join(future.result() for future in pending.popleft()))
+            if rest:
+                raise BamFormatException("The BAM file is truncated.")
+            while pending:
+                yield(b"".join(future.result() for future in pending.popleft()))
+
+    def records(self):
+        """Yield the binary alignment records as (buffer, start, end)"""
+        chunks = self.chunks()
+        buf = b""
+        pos = 0
+
+        def fill(size):
+            nonlocal buf, pos
+            while len(buf) - pos < size:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return(False)
+                buf = buf[pos:] + chunk
+                pos = 0
+            return(True)
+
+        ## header: magic, SAM text, reference sequences
+        if not fill(8) or buf[:4] != b"BAM\1":
+            raise BamFormatException("The input file is not a BAM file.")
+        l_text = INT32.unpack_from(buf, 4)[0]
+        pos = 8
+        if not fill(l_text + 4):
+            raise BamFormatException("The BAM header is truncated.")
+        pos += l_text
+        n_ref = INT32.unpack_from(buf, pos)[0]
+        pos += 4
+        for _ in range(n_ref):
+            if not fill(4):
+                raise BamFormatException("The BAM header is truncated.")
+            l_name = INT32.unpack_from(buf, pos)[0]
+            if not fill(l_name + 8):
+                raise BamFormatException("The BAM header is truncated.")
+            pos += l_name + 8
+
+        ## alignment records
+        while fill(4):
+            block_size = INT32.unpack_from(buf, pos)[0]
+            if not fill(block_size + 4):
+                raise BamFormatException("The BAM file is truncated.")
+            start = pos + 4
+            pos = start + block_size
+            yield(buf, start, pos)
+
+    def cell_reads(self):
+        """Yield (read name, cell ID, sample name) of the records tagged
+            as coming from a putative cell (CN:Z:T).
+        """
+        for buf, start, end in self.records():
+            (ref_id, ref_pos, l_read_name, mapq, bin_, n_cigar_op,
+             flag, l_seq, ) = BAM_RECORD_HEADER.unpack_from(buf, start)
+            name_start = start + 32
+            aux = name_start + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq
+            if buf.find(PUTATIVE_CELL_PATTERN, aux, end) < 0:
+                continue
+            tags = parse_string_tags(buf, aux, end)
+            if tags.get(PUTATIVE_CELL_TAG, b"")[:1] != b"T":
+                continue
+            cell_id, sample_name = tags.get(CELL_TAG), tags.get(SAMPLE_TAG)
+            if cell_id is None or sample_name is None:
+                continue
+            read_name = buf[name_start:name_start + l_read_name - 1]
+            yield(read_name.decode("ascii"), cell_id.decode("ascii"), sample_name.decode("ascii"))
+
+
+def parse_string_tags(buf, pos, end):
+    """Return the string (Z) auxiliary fields of a record as a dict"""
+    tags = {}
+    while pos + 3 <= end:
+        tag, value_type = buf[pos:pos + 2], buf[pos + 2]
+        pos += 3
+        if value_type in AUX_STRING_TYPES:
+            value_end = buf.index(b"\0", pos, end)
+            tags[tag] = buf[pos:value_end]
+            pos = value_end + 1
+        elif value_type in AUX_VALUE_SIZES:
+            pos += AUX_VALUE_SIZES[value_type]
+        elif value_type == AUX_ARRAY_TYPE:
+            count = INT32.unpack_from(buf, pos + 1)[0]
+            pos += 5 + count * AUX_VALUE_SIZES[buf[pos]]
+        else:
+            raise BamFormatException(f"Unknown type of the auxiliary field {tag}.")
+    return(tags)
@@ -0,0 +1,110 @@
+"""batch_writer.py: stores batches of read records on a dedicated thread"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import sys
+import queue
+import threading
+from time import perf_counter
+
+MEMORY_BUDGET = 4 * 1024 ** 3
+QUEUE_DEPTH = 2
+
+## memory taken by a record besides the characters of its strings:
+##  the list slot, the tuple and the headers of its three strings
+RECORD_OVERHEAD = 8 + sys.getsizeof((None, None, None)) + 3 * sys.getsizeof("")
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(text):
+    """Convert a size like 512M or 4G to bytes"""
+    text = str(text).strip().upper().rstrip("B")
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ""
+    try:
+        size = float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit]
+    except ValueError:
+        raise ValueError(f"Invalid size: {text}")
+    return(int(size))
+
+
+def record_size(record):
+    """Estimate the memory taken by a (read ID, cell ID, sample name) record"""
+    read_id, cell_id, sample_name = record
+    return(RECORD_OVERHEAD + len(read_id) + len(cell_id) + len(sample_name))
+
+
+class BatchWriter:
+    """Hands full batches of records to a writer thread through a bounded queue,
+        so the input parsing overlaps with the insertion into the storage.
+    """
+
+    store = None
+    queue_depth = QUEUE_DEPTH
+
+    def __init__(self, store, queue_depth=QUEUE_DEPTH):
+        self.store = store
+        self.queue_depth = queue_depth
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.error = None
+        self.records_stored = 0
+        self.batches_stored = 0
+        self.store_time = 0.0
+        self.producer_stall_time = 0.0
+        self.writer_idle_time = 0.0
+        self.thread = threading.Thread(target=self._run, name="batch writer", daemon=True)
+        self.thread.start()
+
+    def batch_size_limit(self, memory_budget):
+        """Return the batch size in bytes, so that all the batches in flight
+            (queued, being stored and being filled) fit in the memory budget
+        """
+        return(memory_budget // (self.queue_depth + 2))
+
+    def put(self, records):
+        """Queue the batch for storing, wait if the queue is full"""
+        if self.error is not None:
+            raise self.error
+        start = perf_counter()
+        self.queue.put(records)
+        self.producer_stall_time += perf_counter() - start
+
+    def _run(self):
+        """Store the queued batches until the end mark arrives"""
+        while True:
+            start = perf_counter()
+            records = self.queue.get()
+            self.writer_idle_time += perf_counter() - start
+            if records is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                start = perf_counter()
+                count = len(records)
+                self.store(records)
+                self.store_time += perf_counter() - start
+                self.records_stored += count
+                self.batches_stored += 1
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        """Wait until all the queued batches are stored"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        """Return a summary of the insert throughput and the queue stalls"""
+        rate = self.records_stored / self.store_time if self.store_time > 0 else 0
+        return(f"{ '{:,}'.format(self.records_stored) } records stored in {self.batches_stored} batches, "
+               f"insert time {self.store_time:.1f} s ({ '{:,.0f}'.format(rate) } records/s); "
+               f"parsing waited {self.producer_stall_time:.1f} s for the writer, "
+               f"the writer waited {self.writer_idle_time:.1f} s for batches")
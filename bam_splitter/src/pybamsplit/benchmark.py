@@ -0,0 +1,237 @@
+"""benchmark.py: times the build, process and retrieve stages on synthetic data
+
+usage: python3 -m pybamsplit.benchmark --reads 1000000 --output results.json
+"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import os
+import sys
+import glob
+import gzip
+import json
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import traceback
+from time import perf_counter
+from contextlib import redirect_stdout
+
+from .read_processor import ReadProcessor
+from .read_storage import STORAGE_BACKENDS, get_timestamp
+
+THRESHOLD = 0.75
+SEQUENCE_POOL_SIZE = 1024
+READ1_LENGTH = 60
+READ2_LENGTH = 75
+## share of the reads of a singlet cell carrying a random (ambient) sample tag
+AMBIENT_TAG_SHARE = 0.05
+
+
+def read_name(i):
+    """Return a unique Illumina-like read name of the i-th read"""
+    lane, i = i % 4 + 1, i // 4
+    tile, i = 1101 + i % 100, i // 100
+    x, y = i % 30000, i // 30000
+    return(f"BENCH01:1:HBENCHXX:{lane}:{tile}:{x}:{y}")
+
+
+def generate_inputs(work_dir, reads, cells, samples, doublet_fraction, unmatched_fraction, seed=1):
+    """Write extract_fields.mawk-style lines (read ID, cell ID, sample tag) and the matching
+        pair read gzip FASTQ files; return their paths
+    """
+    rng = random.Random(seed)
+    sample_names = [f"SampleTag{i:02d}_hs" for i in range(1, samples + 1)]
+    cell_ids = [str(1000000 + i) for i in range(cells)]
+    cell_samples = {cell_id: rng.choice(sample_names) for cell_id in cell_ids}
+    doublets = set(rng.sample(cell_ids, int(cells * doublet_fraction)))
+    doublet_samples = {cell_id: rng.choice(sample_names) for cell_id in doublets}
+    pool1 = ["".join(rng.choice("ACGT") for _ in range(READ1_LENGTH)) for _ in range(SEQUENCE_POOL_SIZE)]
+    pool2 = ["".join(rng.choice("ACGT") for _ in range(READ2_LENGTH)) for _ in range(SEQUENCE_POOL_SIZE)]
+    quality1, quality2 = "F" * READ1_LENGTH, "F" * READ2_LENGTH
+
+    tags_file = os.path.join(work_dir, "tags.txt")
+    reads1_file = os.path.join(work_dir, "reads1.fastq.gz")
+    reads2_file = os.path.join(work_dir, "reads2.fastq.gz")
+    with open(tags_file, "w") as tags, gzip.open(reads1_file, "wt", compresslevel=1) as f1, \
+            gzip.open(reads2_file, "wt", compresslevel=1) as f2:
+        for i in range(reads):
+            name = read_name(i)
+            if rng.random() >= unmatched_fraction:
+                cell_id = rng.choice(cell_ids)
+                if cell_id in doublets and rng.random() < 0.5:
+                    sample_name = doublet_samples[cell_id]
+                elif rng.random() < AMBIENT_TAG_SHARE:
+                    sample_name = rng.choice(sample_names)
+                else:
+                    sample_name = cell_samples[cell_id]
+                tags.write(f"{name} {cell_id} {sample_name}\n")
+            f1.write(f"@{name} 1:N:0:ACGTACGT\n{rng.choice(pool1)}\n+\n{quality1}\n")
+            f2.write(f"@{name} 2:N:0:ACGTACGT\n{rng.choice(pool2)}\n+\n{quality2}\n")
+    return(tags_file, reads1_file, reads2_file)
+
+
+class BenchmarkException(Exception):
+    pass
+
+
+def run_in_child(function, *args):
+    """Run the function in a forked process, as the commands run one by one;
+        return its result (a JSON-serializable dict) with the peak resident
+        set size (bytes) of that process and of its workers added
+    """
+    read_fd, write_fd = os.pipe()
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            with os.fdopen(write_fd, "w") as f:
+                json.dump(function(*args), f)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        data = f.read()
+    ## unlike RUSAGE_CHILDREN, the usage reported by wait4 is of this child only
+    _, status, usage = os.wait4(pid, 0)
+    if status != 0:
+        raise BenchmarkException(f"The {function.__name__} stage failed.")
+    scale = 1 if sys.platform == "darwin" else 1024
+    result = json.loads(data)
+    result["peak_rss"] = usage.ru_maxrss * scale
+    return(result)
+
+
+def db_size(db_file):
+    """Return the size of the database file(s) in bytes"""
+    return(sum(os.path.getsize(file_name) for file_name in glob.glob(db_file + "*")))
+
+
+def output_size(out_dir):
+    """Return the size of the output FASTQ files in bytes"""
+    return(sum(os.path.getsize(file_name) for file_name in glob.glob(os.path.join(out_dir, "*.fastq.gz"))))
+
+
+def build_stage(out_dir, db_file, processor_options, tags_file):
+    start = perf_counter()
+    with open(tags_file) as input_stream:
+        ReadProcessor(out_dir, db_file, THRESHOLD, **processor_options).read_and_store(input_stream=input_stream)
+    return({"seconds": perf_counter() - start, "db_bytes": db_size(db_file)})
+
+
+def process_stage(out_dir, db_file, processor_options):
+    start = perf_counter()
+    ReadProcessor(out_dir, db_file, THRESHOLD, **processor_options).process_db(False)
+    return({"seconds": perf_counter() - start, "db_bytes": db_size(db_file)})
+
+
+def retrieve_stage(out_dir, db_file, processor_options, reads1_file, reads2_file, fastq_buffer_size):
+    start = perf_counter()
+    ReadProcessor(out_dir, db_file, THRESHOLD, **processor_options).retrieve(
+        reads1_file, reads2_file, fastq_buffer_size)
+    return({"seconds": perf_counter() - start, "output_bytes": output_size(out_dir)})
+
+
+def split_stage(out_dir, db_file, processor_options, tags_file, reads1_file, reads2_file, fastq_buffer_size):
+    start = perf_counter()
+    with open(tags_file) as input_stream:
+        ReadProcessor(out_dir, db_file, THRESHOLD, **processor_options).split(
+            reads1_file, reads2_file, fastq_buffer_size, input_stream=input_stream)
+    return({"seconds": perf_counter() - start, "output_bytes": output_size(out_dir)})
+
+
+def run_stages(work_dir, tags_file, reads1_file, reads2_file, processor_options, fastq_buffer_size):
+    """Run build, process and retrieve, each in its own process with a new ReadProcessor
+        as the commands do; return the measurements of every stage
+    """
+    db_file = os.path.join(work_dir, "bench.db")
+    out_dir = os.path.join(work_dir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+    return({"build": run_in_child(build_stage, out_dir, db_file, processor_options, tags_file),
+            "process": run_in_child(process_stage, out_dir, db_file, processor_options),
+            "retrieve": run_in_child(retrieve_stage, out_dir, db_file, processor_options,
+                                     reads1_file, reads2_file, fastq_buffer_size)})
+
+
+def run_split(work_dir, tags_file, reads1_file, reads2_file, processor_options, fastq_buffer_size):
+    """Run the single-process split command in its own process; return its measurements"""
+    db_file = os.path.join(work_dir, "bench.db")
+    out_dir = os.path.join(work_dir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+    return({"split": run_in_child(split_stage, out_dir, db_file, processor_options,
+                                  tags_file, reads1_file, reads2_file, fastq_buffer_size)})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m pybamsplit.benchmark",
+                                     description="Time the build, process and retrieve stages on synthetic data.")
+    parser.add_argument('--reads', type=int, default=1000000, help='number of read pairs')
+    parser.add_argument('--cells', type=int, default=5000, help='number of cells')
+    parser.add_argument('--samples', type=int, default=12, help='number of sample tags')
+    parser.add_argument('--doublets', type=float, default=0.05, help='fraction of cells with reads of two samples (MULTIPLE)')
+    parser.add_argument('--unmatched', type=float, default=0.2, help='share of FASTQ reads not found in the BAM data (UNDETERMINED)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random generator')
+    parser.add_argument('--backend', choices=list(STORAGE_BACKENDS), default='sqlite', help='storage backend')
+    parser.add_argument('--partitions', type=int, default=1, help='number of database partitions')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='number of compression threads')
+    parser.add_argument('--bgzf', action="store_true", help='write BGZF output files with a read index')
+    parser.add_argument('-F', type=int, default=100000, help='FASTQ reads looked up at once')
+    parser.add_argument('--split', action="store_true", help='time the single-process split command instead of the three commands')
+    parser.add_argument('--work-dir', dest="work_dir", help='directory for the inputs, the database and the outputs (default: a temporary directory)')
+    parser.add_argument('--keep', action="store_true", help='keep the generated inputs and the outputs')
+    parser.add_argument('--output', help='JSON file the results are written to (default: standard output, '
+                                         'the progress is always printed to standard error)')
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="fqsplit_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    parameters = {key: value for key, value in vars(args).items() if key not in ("work_dir", "keep", "output")}
+    ## the standard output is left to the JSON results
+    try:
+        with redirect_stdout(sys.stderr):
+            print(f"{get_timestamp()}    Generating {args.reads:,} synthetic read pairs in {work_dir}", flush=True)
+            start = perf_counter()
+            tags_file, reads1_file, reads2_file = generate_inputs(work_dir, args.reads, args.cells, args.samples,
+                                                                  args.doublets, args.unmatched, args.seed)
+            generate_seconds = perf_counter() - start
+            processor_options = {"backend": args.backend, "partitions": args.partitions,
+                                 "compression_threads": args.threads, "blocked_output": args.bgzf}
+            run = run_split if args.split else run_stages
+            stages = run(work_dir, tags_file, reads1_file, reads2_file, processor_options, args.F)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for stage in stages.values():
+        stage["reads_per_second"] = args.reads / stage["seconds"] if stage["seconds"] > 0 else None
+    results = {"timestamp": get_timestamp(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "cpu_count": os.cpu_count(),
+               "parameters": parameters,
+               "generate_seconds": generate_seconds,
+               "stages": stages}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    return(results)
+
+
+if __name__ == "__main__":
+    main()
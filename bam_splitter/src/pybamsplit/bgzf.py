@@ -0,0 +1,242 @@
+"""bgzf.py: FASTQ output files made of independent BGZF blocks, with a read index"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import os
+import zlib
+import struct
+from collections import deque
+
+GROUP_SIZE = 4 * 1024 * 1024
+COMPRESSION_LEVEL = 9
+## uncompressed bytes per block, the bgzip default keeping the compressed block below 64 KiB
+BLOCK_SIZE = 0xff00
+## the empty block marking the end of a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+INDEX_SUFFIX = ".idx"
+INDEX_HEADER = "#compressed_offset\tuncompressed_offset\tfirst_read\treads\n"
+## the last line of the index holds the sizes of the whole file and the total read count
+INDEX_END = "#end"
+
+## gzip header with the FEXTRA flag and the BC subfield holding the block size - 1
+_HEADER = struct.Struct("<4BI2BH2BHH")
+_FOOTER = struct.Struct("<II")
+
+
+class BgzfException(Exception):
+    pass
+
+
+def compress_block(data, level=COMPRESSION_LEVEL):
+    """Compress up to BLOCK_SIZE bytes into one BGZF block"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = _HEADER.size + len(deflated) + _FOOTER.size
+    if block_size > 0x10000:
+        raise BgzfException(f"The compressed block is too big: {block_size} bytes")
+    return(_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, block_size - 1)
+           + deflated + _FOOTER.pack(zlib.crc32(data), len(data)))
+
+
+def compress_blocks(blocks, level=COMPRESSION_LEVEL):
+    """Compress every block of the list, a unit of work for the thread pool"""
+    return([compress_block(block, level) for block in blocks])
+
+
+def read_index(file_name):
+    """Return the index of the BGZF FASTQ file as a list of
+        (compressed offset, uncompressed offset, first read, reads) tuples
+    """
+    return(_read_index_file(file_name)[0])
+
+
+def _read_index_file(file_name):
+    """Return the index entries and the (compressed size, uncompressed size, reads)
+        totals of the file, None if the index has no end line
+    """
+    entries, totals = [], None
+    with open(file_name + INDEX_SUFFIX) as f:
+        for line in f:
+            if line.startswith(INDEX_END):
+                totals = tuple(map(int, line.split("\t")[1:]))
+            elif not line.startswith("#"):
+                entries.append(tuple(map(int, line.split("\t"))))
+    return(entries, totals)
+
+
+def _write_index_file(file_name, index, totals):
+    """Write the index entries and the totals line of the file"""
+    temp_file_name = file_name + INDEX_SUFFIX + ".tmp"
+    with open(temp_file_name, "w") as f:
+        f.write(INDEX_HEADER)
+        f.writelines(f"{offset}\t{uncompressed_offset}\t{first_read}\t{reads}\n"
+                     for offset, uncompressed_offset, first_read, reads in index)
+        f.write(INDEX_END + "".join(f"\t{total}" for total in totals) + "\n")
+    os.replace(temp_file_name, file_name + INDEX_SUFFIX)
+
+
+def concatenate(file_names, out_file_name):
+    """Join the indexed BGZF files into one, without recompressing:
+        copy the blocks of every file without its end marker and shift its index
+    """
+    index = []
+    offset, uncompressed_offset, reads = 0, 0, 0
+    with open(out_file_name, "wb") as out_file:
+        for file_name in file_names:
+            entries, totals = _read_index_file(file_name)
+            if totals is None:
+                raise BgzfException(f"The index of the file is incomplete: {file_name}")
+            with open(file_name, "rb") as f:
+                copy_size = totals[0]
+                while copy_size > 0:
+                    data = f.read(min(copy_size, 1024 * 1024))
+                    if not data:
+                        raise BgzfException(f"The file is shorter than its index: {file_name}")
+                    out_file.write(data)
+                    copy_size -= len(data)
+            index.extend((entry_offset + offset, entry_uncompressed_offset + uncompressed_offset,
+                          first_read + reads, entry_reads)
+                         for entry_offset, entry_uncompressed_offset, first_read, entry_reads in entries)
+            offset += totals[0]
+            uncompressed_offset += totals[1]
+            reads += totals[2]
+        out_file.write(BGZF_EOF)
+    _write_index_file(out_file_name, index, (offset, uncompressed_offset, reads))
+
+
+class BgzfWriter:
+    """Binary file object writing whole FASTQ records into BGZF blocks,
+        so every block starts with a record (unless a record is longer than a block)
+        and standard gzip readers still read the file as concatenated members.
+        The blocks are compressed in groups on the thread pool, or in place without it.
+        On closing, the index file lists for every block starting with a record
+        its offset in the compressed and in the uncompressed file, the number
+        of the first read (from 0) and the number of reads starting in the block.
+    """
+
+    file = None
+    file_name = None
+    executor = None
+    level = COMPRESSION_LEVEL
+    group_size = GROUP_SIZE
+    max_pending = 0
+
+    def __init__(self, file_name, mode, executor=None, level=COMPRESSION_LEVEL, group_size=GROUP_SIZE, max_pending=4):
+        self.file_name = file_name
+        self.executor = executor
+        self.level = level
+        self.group_size = group_size
+        self.max_pending = max_pending
+        self.index = []
+        self.offset = 0
+        self.uncompressed_offset = 0
+        self.reads = 0
+        self.block = []
+        self.block_size = 0
+        self.block_reads = 0
+        self.group = []
+        self.group_size_now = 0
+        self.pending = deque()
+        if mode.startswith("a") and os.path.exists(file_name):
+            self._reopen()
+        else:
+            self.file = open(file_name, "wb")
+
+    def _reopen(self):
+        """Continue the file closed before: drop its end marker and load its index"""
+        self.file = open(self.file_name, "r+b")
+        self.file.seek(0, os.SEEK_END)
+        end = self.file.tell()
+        if end >= len(BGZF_EOF):
+            self.file.seek(end - len(BGZF_EOF))
+            if self.file.read() == BGZF_EOF:
+                end -= len(BGZF_EOF)
+                self.file.truncate(end)
+        self.file.seek(end)
+        self.offset = end
+        totals = None
+        if os.path.exists(self.file_name + INDEX_SUFFIX):
+            self.index, totals = _read_index_file(self.file_name)
+        if totals is not None and totals[0] == end:
+            _, self.uncompressed_offset, self.reads = totals
+        else:
+            raise BgzfException(f"The index does not match the file, cannot append to: {self.file_name}")
+
+    def write_records(self, records):
+        """Write the FASTQ records (bytes, each ending with a new line)"""
+        for record in records:
+            length = len(record)
+            if self.block_size + length > BLOCK_SIZE and self.block:
+                self._end_block()
+            if length > BLOCK_SIZE:
+                ## a record longer than a block; only its first piece starts with a record
+                for start in range(0, length, BLOCK_SIZE):
+                    self.block.append(record[start:start + BLOCK_SIZE])
+                    self.block_size = len(self.block[0])
+                    self.block_reads = 1 if start == 0 else 0
+                    self._end_block(indexed=(start == 0))
+                continue
+            self.block.append(record)
+            self.block_size += length
+            self.block_reads += 1
+
+    def _end_block(self, indexed=True):
+        """Add the current block to the group compressed at once"""
+        data = b"".join(self.block)
+        self.group.append((data, self.block_reads, indexed))
+        self.group_size_now += len(data)
+        self.block, self.block_size, self.block_reads = [], 0, 0
+        if self.group_size_now >= self.group_size:
+            self._submit_group()
+
+    def _submit_group(self):
+        """Compress the group of blocks on the thread pool or in place"""
+        if not self.group:
+            return
+        blocks = [data for data, _, _ in self.group]
+        meta = [(len(data), reads, indexed) for data, reads, indexed in self.group]
+        self.group, self.group_size_now = [], 0
+        if self.executor is None:
+            self._write_blocks(compress_blocks(blocks, self.level), meta)
+        else:
+            self.pending.append((self.executor.submit(compress_blocks, blocks, self.level), meta))
+            self._write_pending(self.max_pending)
+
+    def _write_pending(self, keep_pending):
+        """Write the compressed groups in order until at most keep_pending are left"""
+        while len(self.pending) > keep_pending:
+            future, meta = self.pending.popleft()
+            self._write_blocks(future.result(), meta)
+
+    def _write_blocks(self, compressed_blocks, meta):
+        """Write the compressed blocks and add them to the index"""
+        for compressed, (size, reads, indexed) in zip(compressed_blocks, meta):
+            if indexed:
+                self.index.append((self.offset, self.uncompressed_offset, self.reads, reads))
+            self.file.write(compressed)
+            self.offset += len(compressed)
+            self.uncompressed_offset += size
+            self.reads += reads
+
+    def flush(self):
+        """Compress and write all the complete records written so far"""
+        if self.block:
+            self._end_block()
+        self._submit_group()
+        self._write_pending(0)
+        self.file.flush()
+
+    def close(self):
+        """Write the remaining blocks, the end marker and the index"""
+        if self.file is not None:
+            try:
+                self.flush()
+                self.file.write(BGZF_EOF)
+            finally:
+                self.file.close()
+                self.file = None
+            _write_index_file(self.file_name, self.index, (self.offset, self.uncompressed_offset, self.reads))
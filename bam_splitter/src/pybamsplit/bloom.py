@@ -0,0 +1,167 @@
+"""bloom.py: Bloom filter of the associated read IDs, screening the retrieve lookups"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import os
+import math
+import struct
+from itertools import islice
+
+## the read IDs are hashed and probed in batches with numpy, it is required only by --bloom
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BLOOM_FILE_SUFFIX = ".bloom"
+FALSE_POSITIVE_RATE = 0.01
+MAGIC = b"FQSPBLM2"
+## magic, number of bits, number of hash functions, number of read IDs added
+_HEADER = struct.Struct("<8sQQQ")
+## read IDs hashed at once while the filter is built
+HASH_BATCH_SIZE = 100000
+
+
+class BloomFilterException(Exception):
+    pass
+
+
+def require_numpy():
+    """Raise BloomFilterException if numpy, which hashes and probes the read IDs, is missing"""
+    if numpy is None:
+        raise BloomFilterException("The Bloom filter (--bloom) requires numpy, install it first.")
+
+
+def bloom_filter_for(capacity, false_positive_rate=FALSE_POSITIVE_RATE):
+    """Return an empty filter sized for capacity read IDs at the false-positive rate"""
+    if not 0 < false_positive_rate < 1:
+        raise BloomFilterException(f"The false-positive rate must be between 0 and 1: {false_positive_rate}")
+    capacity = max(1, capacity)
+    bits = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return(BloomFilter(bits, hashes))
+
+
+def load_bloom_filter(file_name):
+    """Load the filter saved by BloomFilter.save()"""
+    try:
+        with open(file_name, "rb") as f:
+            magic, bits, hashes, count = _HEADER.unpack(f.read(_HEADER.size))
+            bit_array = bytearray(f.read())
+    except (OSError, struct.error) as e:
+        raise BloomFilterException(f"Cannot read the Bloom filter {file_name}: {e}")
+    if magic != MAGIC or len(bit_array) != (bits + 7) // 8:
+        raise BloomFilterException(f"Not a Bloom filter: {file_name}")
+    return(BloomFilter(bits, hashes, bit_array, count))
+
+
+def remove_bloom_filter(file_name):
+    """Delete the filter file"""
+    if os.path.exists(file_name):
+        os.remove(file_name)
+
+
+def _mix(values):
+    """Finalize the 64-bit hashes in place (the murmur3 fmix64 step)"""
+    values ^= values >> numpy.uint64(33)
+    values *= numpy.uint64(0xff51afd7ed558ccd)
+    values ^= values >> numpy.uint64(33)
+    values *= numpy.uint64(0xc4ceb9fe1a85ec53)
+    values ^= values >> numpy.uint64(33)
+    return(values)
+
+
+def hash_read_ids(read_ids):
+    """Return the two 64-bit hashes of every read ID of the list, for double hashing:
+        FNV-1a over the characters, one vectorized step per character position
+        of the whole batch, finalized by fmix64
+    """
+    characters = numpy.array(read_ids, dtype=str)
+    width = characters.dtype.itemsize // 4
+    ## UCS4 code points, the shorter read IDs are padded with zeros
+    codes = characters.view(numpy.uint32).reshape(len(read_ids), width).astype(numpy.uint64)
+    first = numpy.full(len(read_ids), 0xcbf29ce484222325, dtype=numpy.uint64)
+    prime = numpy.uint64(0x100000001b3)
+    for position in range(width):
+        column = codes[:, position]
+        ## the padding is skipped, the hash does not depend on the batch
+        numpy.copyto(first, (first ^ column) * prime, where=column != 0)
+    _mix(first)
+    second = _mix(first ^ numpy.uint64(0x9e3779b97f4a7c15)) | numpy.uint64(1)
+    return(first, second)
+
+
+class BloomFilter:
+    """Bit array answering whether a read ID may have been added: a miss is certain,
+        a hit is false with a probability growing with the read IDs added.
+        The bit positions are derived by double hashing from two 64-bit hashes,
+        which are computed and probed for a whole batch of read IDs at once.
+    """
+
+    bits = 0
+    hashes = 0
+    count = 0
+    bit_array = None
+
+    def __init__(self, bits, hashes, bit_array=None, count=0):
+        require_numpy()
+        self.bits = bits
+        self.hashes = hashes
+        self.bit_array = bit_array if bit_array is not None else bytearray((bits + 7) // 8)
+        ## writable view of the same memory
+        self.bit_view = numpy.frombuffer(self.bit_array, dtype=numpy.uint8)
+        self.count = count
+
+    def _positions(self, read_ids):
+        """Yield the bit positions of the read IDs of the list, one array per hash function"""
+        first, second = hash_read_ids(read_ids)
+        bits = numpy.uint64(self.bits)
+        for _ in range(self.hashes):
+            yield(first % bits)
+            first += second
+
+    def update(self, read_ids):
+        """Add all the read IDs, batch by batch"""
+        read_ids = iter(read_ids)
+        batch = list(islice(read_ids, HASH_BATCH_SIZE))
+        while batch:
+            for positions in self._positions(batch):
+                shifts = (positions & numpy.uint64(7)).astype(numpy.uint8)
+                numpy.bitwise_or.at(self.bit_view, positions >> numpy.uint64(3), numpy.uint8(1) << shifts)
+            self.count += len(batch)
+            batch = list(islice(read_ids, HASH_BATCH_SIZE))
+
+    def screen(self, read_ids):
+        """Return the read IDs of the list which may have been added"""
+        if not read_ids:
+            return([])
+        bit_view = self.bit_view
+        passed = numpy.ones(len(read_ids), dtype=bool)
+        for positions in self._positions(read_ids):
+            shifts = (positions & numpy.uint64(7)).astype(numpy.uint8)
+            passed &= ((bit_view[positions >> numpy.uint64(3)] >> shifts) & numpy.uint8(1)).astype(bool)
+        return([read_ids[i] for i in numpy.flatnonzero(passed).tolist()])
+
+    def __contains__(self, read_id):
+        return(bool(self.screen([read_id])))
+
+    @property
+    def size(self):
+        """Size of the bit array in bytes"""
+        return(len(self.bit_array))
+
+    def false_positive_rate(self):
+        """Return the expected false-positive rate with the read IDs added so far"""
+        return((1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes)
+
+    def save(self, file_name):
+        """Write the filter into the file"""
+        temp_file_name = file_name + ".tmp"
+        with open(temp_file_name, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, self.bits, self.hashes, self.count))
+            f.write(self.bit_array)
+        os.replace(temp_file_name, file_name)
@@ -0,0 +1,133 @@
+"""compression.py: gzip output files deflated on a pool of threads"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import gzip
+import zlib
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .bgzf import BgzfWriter, concatenate
+
+CHUNK_SIZE = 4 * 1024 * 1024
+COMPRESSION_LEVEL = 9
+
+
+def deflate_member(data, level=COMPRESSION_LEVEL):
+    """Compress the data into a complete gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return(compressor.compress(data) + compressor.flush())
+
+
+class ParallelGzipWriter:
+    """Binary file object writing a gzip file of concatenated members;
+        the data are collected into chunks and each chunk is deflated
+        on a thread pool (zlib releases the GIL). The members are written
+        in the order of the chunks.
+    """
+
+    file = None
+    executor = None
+    level = COMPRESSION_LEVEL
+    chunk_size = CHUNK_SIZE
+    max_pending = 0
+
+    def __init__(self, file_name, mode, executor, level=COMPRESSION_LEVEL, chunk_size=CHUNK_SIZE, max_pending=4):
+        self.file = open(file_name, mode)
+        self.executor = executor
+        self.level = level
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending
+        self.buffer = []
+        self.buffered = 0
+        self.pending = deque()
+
+    def write(self, data):
+        """Buffer the data, hand the full chunks to the thread pool"""
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self._submit_buffer()
+        return(len(data))
+
+    def _submit_buffer(self):
+        """Split the buffered data into chunks and deflate them on the thread pool"""
+        data = memoryview(b"".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+        for start in range(0, len(data), self.chunk_size):
+            self.pending.append(self.executor.submit(deflate_member, data[start:start + self.chunk_size], self.level))
+            self._write_members(self.max_pending)
+
+    def _write_members(self, keep_pending):
+        """Write the compressed members in order until at most keep_pending are left"""
+        while len(self.pending) > keep_pending:
+            self.file.write(self.pending.popleft().result())
+
+    def flush(self):
+        """Compress and write everything written so far"""
+        if self.buffered > 0:
+            self._submit_buffer()
+        self._write_members(0)
+        self.file.flush()
+
+    def close(self):
+        """Flush the data and close the file"""
+        if self.file is not None:
+            try:
+                self.flush()
+            finally:
+                self.file.close()
+                self.file = None
+
+
+class OutputCompressor:
+    """Opens gzip output files sharing one compression thread pool;
+        with a single thread, plain gzip file objects are used.
+        With blocked output, the files are written as indexed BGZF blocks
+        by write_records() instead of write().
+    """
+
+    threads = 1
+    level = COMPRESSION_LEVEL
+    executor = None
+    blocked = False
+
+    def __init__(self, threads=1, level=COMPRESSION_LEVEL, blocked=False):
+        self.threads = max(1, threads)
+        self.level = level
+        self.blocked = blocked
+        if self.threads > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+
+    def open(self, file_name, mode="wb"):
+        """Return a writable binary file object compressing into the file"""
+        if self.blocked:
+            return(BgzfWriter(file_name, mode, self.executor, self.level, max_pending=2 * self.threads))
+        if self.executor is None:
+            return(gzip.open(file_name, mode, compresslevel=self.level))
+        return(ParallelGzipWriter(file_name, mode, self.executor, self.level,
+                                  max_pending=2 * self.threads))
+
+    def concatenate(self, file_names, out_file_name):
+        """Join the compressed files made by this compressor into one, without recompressing;
+            gzip files are concatenated as members
+        """
+        if self.blocked:
+            concatenate(file_names, out_file_name)
+            return
+        with open(out_file_name, "wb") as out_file:
+            for file_name in file_names:
+                with open(file_name, "rb") as f:
+                    shutil.copyfileobj(f, out_file, 1024 * 1024)
+
+    def shutdown(self):
+        """Stop the compression threads"""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
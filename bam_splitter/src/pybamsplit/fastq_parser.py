@@ -0,0 +1,94 @@
+"""fastq_parser.py: splits decompressed chunks of FASTQ files into records in bulk"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+from itertools import repeat
+
+
+class FastqFormatException(Exception):
+    pass
+
+
+def split_records(buf):
+    """Find the complete 4-line records in the buffer;
+        return the header lines, the records and the number of bytes
+        the records take.
+    """
+    lines = buf.split(b"\n")
+    line_count = (len(lines) - 1) // 4 * 4
+    if line_count == 0:
+        return([], [], 0)
+    headers = lines[0:line_count:4]
+    ## join the 4 lines of each record, with the trailing line end
+    records = list(map(b"\n".join, zip(headers, lines[1:line_count:4], lines[2:line_count:4],
+                                       lines[3:line_count:4], repeat(b"", len(headers)))))
+    return(headers, records, sum(map(len, records)))
+
+
+def crop_read_ids(headers):
+    """Return the read IDs of the header lines without the prefix
+        until the second ":" (see read_processor.crop_read_id)
+    """
+    if not all(map(bytes.startswith, headers, repeat(b"@"))):
+        header = next(header for header in headers if not header.startswith(b"@"))
+        raise FastqFormatException(f"Read ID was not found in the line: {header[:50]}...")
+    try:
+        read_ids = [header.split(maxsplit=1)[0].split(b":", maxsplit=2)[2] for header in headers]
+    except IndexError:
+        header = next(header for header in headers if header.split(maxsplit=1)[0].count(b":") < 2)
+        raise FastqFormatException(f"Read ID was not found in the line: {header[:50]}...")
+    return(b"\n".join(read_ids).decode("ascii").split("\n"))
+
+
+def record_batches(chunks):
+    """Yield (cropped read IDs, records) for every chunk of a FASTQ file;
+        the records split between the chunks are carried over.
+    """
+    rest = b""
+    for chunk in chunks:
+        buf = rest + chunk if rest else chunk
+        headers, records, end = split_records(buf)
+        rest = buf[end:]
+        if records:
+            yield(crop_read_ids(headers), records)
+    if rest:
+        if not rest.endswith(b"\n"):
+            rest += b"\n"
+        headers, records, end = split_records(rest)
+        if rest[end:].strip():
+            raise FastqFormatException("The FASTQ file is truncated, the last record is incomplete.")
+        if records:
+            yield(crop_read_ids(headers), records)
+
+
+def paired_batches(chunks1, chunks2):
+    """Yield (cropped read IDs, records1, records2) batches of the paired
+        FASTQ files, checking that the reads are in the same order.
+    """
+    batches1, batches2 = record_batches(chunks1), record_batches(chunks2)
+    ids1, records1, ids2, records2 = [], [], [], []
+    read_counter = 0
+    while True:
+        if not ids1:
+            ids1, records1 = next(batches1, ([], []))
+        if not ids2:
+            ids2, records2 = next(batches2, ([], []))
+        if not ids1 or not ids2:
+            if ids1 or ids2:
+                raise FastqFormatException("The FASTQ files contain different numbers of reads.")
+            return
+        n = min(len(ids1), len(ids2))
+        batch_ids = ids1[:n]
+        if batch_ids != ids2[:n]:
+            i = next(i for i in range(n) if ids1[i] != ids2[i])
+            raise FastqFormatException(
+                f"""The fastq files are not organized in the same order, read nr. {read_counter + i},
+                    read1 ID: {ids1[i]}, read2 ID: {ids2[i]}.""")
+        yield(batch_ids, records1[:n], records2[:n])
+        read_counter += n
+        ids1, records1 = ids1[n:], records1[n:]
+        ids2, records2 = ids2[n:], records2[n:]
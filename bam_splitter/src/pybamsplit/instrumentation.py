@@ -0,0 +1,118 @@
+"""instrumentation.py: cumulative timers and counters of the processing stages, optional profiling"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import cProfile
+from contextlib import contextmanager
+from time import perf_counter
+
+MB = 1024 * 1024
+
+
+class Instrumentation:
+    """Accumulates the time spent and the number of calls per stage,
+        plus named counters (e.g. bytes read and written).
+        The overhead is two perf_counter() calls per timed block,
+        so the blocks should be batches, not single reads.
+    """
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.timers = {}
+        self.counters = {}
+        self.last_progress = None
+
+    @contextmanager
+    def timed(self, stage):
+        """Add the time spent in the with block to the stage"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, perf_counter() - start)
+
+    def timed_iter(self, stage, iterable):
+        """Yield the items of the iterable, adding the time spent producing them to the stage"""
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, perf_counter() - start)
+                return
+            self.add_time(stage, perf_counter() - start)
+            yield item
+
+    def add_time(self, stage, seconds, calls=1):
+        """Add seconds measured elsewhere (e.g. on another thread) to the stage"""
+        timer = self.timers.get(stage)
+        if timer is None:
+            timer = self.timers[stage] = [0.0, 0]
+        timer[0] += seconds
+        timer[1] += calls
+
+    def count(self, counter, value=1):
+        """Increase the counter"""
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def merge(self, timings):
+        """Add the timers and the counters of another process, in the form of as_dict()"""
+        for stage, timer in timings["stages"].items():
+            self.add_time(stage, timer["seconds"], timer["calls"])
+        for counter, value in timings["counters"].items():
+            self.count(counter, value)
+
+    def seconds(self, stage):
+        return(self.timers.get(stage, (0.0, 0))[0])
+
+    def calls(self, stage):
+        return(self.timers.get(stage, (0.0, 0))[1])
+
+    def progress(self, reads, bytes_in, bytes_out, lookup_stage="lookup"):
+        """Return the throughput since the previous call: reads/s, MB/s in and out
+            and the mean time per lookup batch
+        """
+        now = perf_counter()
+        current = (now, reads, bytes_in, bytes_out, self.seconds(lookup_stage), self.calls(lookup_stage))
+        previous = self.last_progress or (self.started, 0, 0, 0, 0.0, 0)
+        self.last_progress = current
+        elapsed = max(now - previous[0], 1e-9)
+        batches = current[5] - previous[5]
+        lookup_ms = 1000 * (current[4] - previous[4]) / batches if batches else 0.0
+        return(f"{(reads - previous[1]) / elapsed:,.0f} reads/s, "
+               f"in {(bytes_in - previous[2]) / MB / elapsed:.1f} MB/s, "
+               f"out {(bytes_out - previous[3]) / MB / elapsed:.1f} MB/s, "
+               f"{lookup_ms:.1f} ms per lookup batch")
+
+    def report(self):
+        """Return the breakdown of the time per stage, one stage per line"""
+        total = perf_counter() - self.started
+        lines = [f"{'stage':>24}{'seconds':>10}{'share':>8}{'calls':>10}"]
+        for stage, (seconds, calls) in self.timers.items():
+            share = 100 * seconds / total if total > 0 else 0.0
+            lines.append(f"{stage:>24}{seconds:>10.2f}{share:>7.1f}%{calls:>10,}")
+        lines.append(f"{'wall clock':>24}{total:>10.2f}")
+        return("\n".join(lines))
+
+    def as_dict(self):
+        """Return the timers and the counters in a JSON-serializable form"""
+        return({"wall_seconds": round(perf_counter() - self.started, 3),
+                "stages": {stage: {"seconds": round(seconds, 3), "calls": calls}
+                           for stage, (seconds, calls) in self.timers.items()},
+                "counters": dict(self.counters)})
+
+
+def run_profiled(function, profile_file, *args, **kwargs):
+    """Run the function under cProfile and dump the statistics to the file
+        (open it with python3 -m pstats or snakeviz); only the calling thread is profiled
+    """
+    profiler = cProfile.Profile()
+    try:
+        return(profiler.runcall(function, *args, **kwargs))
+    finally:
+        profiler.dump_stats(profile_file)
@@ -0,0 +1,121 @@
+"""output_manager.py: buffered per-sample output FASTQ files with a bounded number of open handles"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import os
+from collections import OrderedDict
+
+FLUSH_SIZE = 8 * 1024 * 1024
+BUFFERED_SIZE_LIMIT = 512 * 1024 * 1024
+MAX_OPEN_FILES = 128
+
+
+class OutputManager:
+    """Collects the reads of every sample in memory and writes them
+        in large blocks once the sample buffer reaches the flush size.
+        At most max_open_files output files are kept open; the least recently
+        used pair is closed and reopened later in append mode, adding new
+        gzip members to the file.
+    """
+
+    out_dir = None
+    compressor = None
+    flush_size = FLUSH_SIZE
+    buffered_size_limit = BUFFERED_SIZE_LIMIT
+    max_open_pairs = MAX_OPEN_FILES // 2
+
+    def __init__(self, out_dir, compressor, flush_size=FLUSH_SIZE, max_open_files=MAX_OPEN_FILES,
+                 buffered_size_limit=BUFFERED_SIZE_LIMIT):
+        self.out_dir = out_dir
+        self.compressor = compressor
+        self.flush_size = flush_size
+        self.buffered_size_limit = max(buffered_size_limit, flush_size)
+        self.max_open_pairs = max(1, max_open_files // 2)
+        self.buffers = {}
+        self.buffered_size = 0
+        self.open_files = OrderedDict()
+        self.created = set()
+        self.written = {}
+        self.bytes_written = 0
+
+    def file_names(self, sample):
+        """Return the pair read output file names of the sample"""
+        return(os.path.join(self.out_dir, sample + "_reads1.fastq.gz"),
+               os.path.join(self.out_dir, sample + "_reads2.fastq.gz"))
+
+    def write(self, sample, records1, records2):
+        """Buffer the pair read records of the sample, write them out
+            when the sample buffer or all the buffers together get too big
+        """
+        buffer = self.buffers.get(sample)
+        if buffer is None:
+            buffer = self.buffers[sample] = [[], [], 0]
+        size = sum(map(len, records1)) + sum(map(len, records2))
+        buffer[0].extend(records1)
+        buffer[1].extend(records2)
+        buffer[2] += size
+        self.buffered_size += size
+        written = self.written.setdefault(sample, [0, 0])
+        written[0] += len(records1)
+        written[1] += size
+        self.bytes_written += size
+        if buffer[2] >= self.flush_size:
+            self._flush(sample)
+        while self.buffered_size > self.buffered_size_limit:
+            self._flush(max(self.buffers, key=lambda s: self.buffers[s][2]))
+
+    def _flush(self, sample):
+        """Write the buffered records of the sample as one block per file"""
+        records1, records2, size = self.buffers[sample]
+        if size == 0:
+            return
+        out_file1, out_file2 = self._get_files(sample)
+        if self.compressor.blocked:
+            out_file1.write_records(records1)
+            out_file2.write_records(records2)
+        else:
+            out_file1.write(b"".join(records1))
+            out_file2.write(b"".join(records2))
+        self.buffers[sample] = [[], [], 0]
+        self.buffered_size -= size
+
+    def _get_files(self, sample):
+        """Return the open files of the sample, closing the least recently used ones if needed"""
+        files = self.open_files.get(sample)
+        if files is not None:
+            self.open_files.move_to_end(sample)
+            return(files)
+        while len(self.open_files) >= self.max_open_pairs:
+            _, (out_file1, out_file2) = self.open_files.popitem(last=False)
+            out_file1.close()
+            out_file2.close()
+        mode = "ab" if sample in self.created else "wb"
+        self.created.add(sample)
+        file_name1, file_name2 = self.file_names(sample)
+        files = (self.compressor.open(file_name1, mode), self.compressor.open(file_name2, mode))
+        self.open_files[sample] = files
+        return(files)
+
+    def get_written_summary(self):
+        """Return {sample: {"read_pairs", "bytes", "compressed_bytes"}} of the reads written so far;
+            the compressed size is final only after closing the files
+        """
+        summary = {}
+        for sample, (read_pairs, size) in self.written.items():
+            compressed_size = sum(os.path.getsize(file_name) for file_name in self.file_names(sample)
+                                  if os.path.exists(file_name))
+            summary[sample] = {"read_pairs": read_pairs, "bytes": size, "compressed_bytes": compressed_size}
+        return(summary)
+
+    def close(self):
+        """Write all the buffered records and close the files"""
+        for sample in list(self.buffers):
+            self._flush(sample)
+        for out_file1, out_file2 in self.open_files.values():
+            out_file1.close()
+            out_file2.close()
+        self.open_files.clear()
@@ -0,0 +1,181 @@
+"""partitioned_storage.py: read information split into partition databases processed in parallel"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import os
+import zlib
+from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from .read_storage import (ReadStorage, SQLReadStorage, DatabaseException, STORAGE_BACKENDS,
+                           assign_cells_to_samples, get_timestamp)
+from .stats import summarize_assignment
+
+
+def _aggregate_partition(storage_class, file_name):
+    """Count the reads per cell and sample in one partition"""
+    storage = storage_class(file_name)
+    try:
+        if not storage._table_exists("cells_stat"):
+            storage._calculate_stats_on_cells()
+        return(storage.get_cell_sample_abundances())
+    finally:
+        storage.close()
+
+
+def _join_partition(storage_class, file_name, cell_samples, samples):
+    """Load the cell assignment into one partition and create its association table"""
+    storage = storage_class(file_name)
+    try:
+        storage.load_cell_assignments(cell_samples)
+        storage._create_association(samples)
+    finally:
+        storage.close()
+
+
+def _cleanup_partition(storage_class, file_name):
+    """Delete the initial read table from one partition"""
+    storage = storage_class(file_name)
+    try:
+        storage.cleanup()
+    finally:
+        storage.close()
+
+
+class PartitionedReadStorage(ReadStorage):
+    """Splits the reads by a hash of the cropped read ID into partition databases.
+        The per-cell counts are aggregated in every partition in parallel and
+        summed up, the (small) cell assignment is calculated once and the
+        association tables are then created in every partition in parallel.
+        The lookups are routed to the partition of the read ID.
+        CRC32 is used as the hash, because it is stable across processes.
+    """
+
+    db_file_name = None
+    storage_class = None
+    partitions = 1
+    processes = 1
+    parts = None
+    cell_sample_counts = None
+    cell_samples = None
+
+    def __init__(self, backend, file_name, partitions, processes=None):
+        storage_class = STORAGE_BACKENDS.get(backend)
+        if storage_class is None or not issubclass(storage_class, SQLReadStorage):
+            raise DatabaseException(f"Partitioning is supported only with the SQLite backends, not: {backend}")
+        self.db_file_name = file_name
+        self.storage_class = storage_class
+        self.partitions = partitions
+        self.processes = min(partitions, processes or os.cpu_count() or 1)
+        self.parts = [storage_class(self.partition_file_name(i)) for i in range(partitions)]
+
+    def partition_file_name(self, partition):
+        """Return the file name of the partition database"""
+        return(f"{self.db_file_name}.part{partition}")
+
+    def set_instrumentation(self, instrumentation):
+        """Record the time of the storage operations of all the partitions."""
+        self.instrumentation = instrumentation
+        for part in self.parts:
+            part.set_instrumentation(instrumentation)
+
+    def setup(self):
+        """Create the initial table in every partition."""
+        for part in self.parts:
+            part.setup()
+
+    def store(self, records):
+        """Insert the records into their partitions."""
+        partitions = self.partitions
+        partition_records = [[] for _ in range(partitions)]
+        for record in records:
+            partition_records[zlib.crc32(record[0].encode("ascii")) % partitions].append(record)
+        for part, part_records in zip(self.parts, partition_records):
+            if part_records:
+                part.store(part_records)
+        records.clear()
+
+    def commit(self):
+        """Commit the changes to all the partitions."""
+        for part in self.parts:
+            part.commit()
+
+    def _map(self, function, *args):
+        """Run the function for every partition in the process pool."""
+        file_names = [self.partition_file_name(i) for i in range(self.partitions)]
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            return(list(executor.map(function, [self.storage_class] * self.partitions, file_names,
+                                     *[[arg] * self.partitions for arg in args])))
+
+    def process_data(self, threshold, samples=None):
+        """Calculate the final association tables of the partitions,
+            with only the reads of the cells assigned to the samples if given.
+        """
+        if self.get_selected_samples() is not None:
+            raise DatabaseException("The association tables keep only the reads of the samples selected before, "
+                                    "build the database again to re-run process.")
+        self.close()
+        print(f"{get_timestamp()}           * Calculating stats on cells in {self.partitions} partitions")
+        cell_sample_counts = defaultdict(Counter)
+        for abundances in self._map(_aggregate_partition):
+            for cell_id, sample_name, abundance in abundances:
+                cell_sample_counts[cell_id][sample_name] += abundance
+        print(f"{get_timestamp()}           * Assigning cells to samples")
+        self.cell_sample_counts = cell_sample_counts
+        self.cell_samples = assign_cells_to_samples(cell_sample_counts, threshold)
+        print(f"{get_timestamp()}           * Creating the association tables")
+        self._map(_join_partition, self.cell_samples, samples)
+
+    def get_sample_summary(self):
+        """Return {sample: {"cells": count, "reads": count}} of the assigned cells."""
+        return(summarize_assignment(self.cell_sample_counts, self.cell_samples))
+
+    def get_cell_sample_counts(self):
+        """Return {cell ID: {sample: abundance}} summed up over the partitions."""
+        return(self.cell_sample_counts)
+
+    def cleanup(self):
+        """Delete the initial read tables from the partitions."""
+        self.close()
+        self._map(_cleanup_partition)
+
+    def get_multiple_read_sample_pairs(self, key_list):
+        """Return sample for read IDs provided in the argument"""
+        partitions = self.partitions
+        partition_keys = [[] for _ in range(partitions)]
+        for key in key_list:
+            partition_keys[zlib.crc32(key.encode("ascii")) % partitions].append(key)
+        result = {}
+        for part, keys in zip(self.parts, partition_keys):
+            if keys:
+                result.update(part.get_multiple_read_sample_pairs(keys))
+        return(result)
+
+    def get_selected_samples(self):
+        """Return the samples the association tables were restricted to, None if they keep all the reads."""
+        return(self.parts[0].get_selected_samples())
+
+    def iter_read_cells(self):
+        """Yield the (read ID, cell ID) pairs of all the partitions."""
+        for part in self.parts:
+            yield from part.iter_read_cells()
+
+    def get_cell_samples(self):
+        """Return the {cell ID: sample} assignment."""
+        return(self.cell_samples)
+
+    def close(self):
+        """Close the connections to all the partitions."""
+        for part in self.parts:
+            part.close()
+
+    def remove_db(self):
+        """Delete the partition databases."""
+        for part in self.parts:
+            part.close()
+            if os.path.exists(part.db_file_name):
+                os.remove(part.db_file_name)
@@ -0,0 +1,91 @@
+"""prefetch.py: read-ahead decompression of the input files on background threads"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import gzip
+import queue
+import threading
+from time import perf_counter
+
+CHUNK_SIZE = 4 * 1024 * 1024
+QUEUE_DEPTH = 4
+
+_END = object()
+
+
+class PrefetchingReader:
+    """Decompresses a gzip file on a background thread into a bounded queue
+        of large byte chunks, so the inflation overlaps with the consumer.
+        At most queue_depth + 2 chunks of the file are held in memory.
+    """
+
+    file_name = None
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, file_name, chunk_size=CHUNK_SIZE, queue_depth=QUEUE_DEPTH):
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+        ## compressed bytes read, decompressed bytes produced, seconds spent inflating
+        ## on the background thread and seconds the consumer waited for a chunk
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.inflate_time = 0.0
+        self.wait_time = 0.0
+        self.queue = queue.Queue(maxsize=max(1, queue_depth))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f"prefetch {file_name}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """Decompress the file chunk by chunk into the queue"""
+        try:
+            with gzip.open(self.file_name, 'rb') as f:
+                while not self.stopped.is_set():
+                    start = perf_counter()
+                    chunk = f.read(self.chunk_size)
+                    self.inflate_time += perf_counter() - start
+                    self.bytes_in = f.fileobj.tell()
+                    if not chunk:
+                        break
+                    self.bytes_out += len(chunk)
+                    self._put(chunk)
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._put(_END)
+
+    def _put(self, item):
+        """Wait for a free slot in the queue unless the reader was closed"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def chunks(self):
+        """Yield the decompressed chunks in the order of the file"""
+        while True:
+            start = perf_counter()
+            item = self.queue.get()
+            self.wait_time += perf_counter() - start
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """Stop the background thread"""
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
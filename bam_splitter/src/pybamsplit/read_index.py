@@ -0,0 +1,287 @@
+"""read_index.py: read-only, memory-mapped read -- cell index for the retrieve lookups"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import os
+import json
+import mmap
+import struct
+from hashlib import blake2b
+from itertools import islice
+
+## the index is sorted and searched with numpy, it is required only by --mmap-index
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .read_storage import ReadKeyCodec, LANE_BITS, TILE_BITS, X_BITS, Y_BITS
+
+INDEX_FILE_SUFFIX = ".mmidx"
+CELLS_FILE_SUFFIX = ".cells.json"
+MAGIC = b"FQSPIDX1"
+## magic, number of keys, offset and size of the JSON trailer
+_HEADER = struct.Struct("<8sQQQ")
+## the packed Illumina read keys use 63 bits, the hashed keys have the top bit set
+HASHED_KEY_BIT = 1 << 63
+## the cell code of keys shared by several read IDs, resolved by the collision table
+COLLISION_CODE = 0xffffffff
+## read IDs packed at once while the index is built
+PACK_BATCH_SIZE = 100000
+## longest coordinate parsed, the widest (21 bits) has 7 digits
+MAX_DIGITS = 10
+
+
+class ReadIndexException(Exception):
+    pass
+
+
+def require_numpy():
+    """Raise ReadIndexException if numpy, which sorts and searches the index, is missing"""
+    if numpy is None:
+        raise ReadIndexException("The memory-mapped read index (--mmap-index) requires numpy, install it first.")
+
+
+def hash_read_id(read_id):
+    """Return the 64-bit key of a read ID which cannot be packed"""
+    return(int.from_bytes(blake2b(read_id.encode("ascii"), digest_size=8).digest(), "little") | HASHED_KEY_BIT)
+
+
+def _pack_coordinates(flowcell, read_ids, keys):
+    """Pack the Illumina read IDs (flowcell:lane:tile:x:y) of the flowcell into the keys
+        as ReadKeyCodec.pack() does, parsing the characters of the whole batch column
+        by column; return the mask of the read IDs packed
+    """
+    count = len(read_ids)
+    characters = numpy.array(read_ids, dtype=str)
+    width = characters.dtype.itemsize // 4
+    prefix = len(flowcell) + 1
+    if width <= prefix:
+        return(numpy.zeros(count, dtype=bool))
+    ## UCS4 code points, the shorter read IDs are padded with zeros
+    codes = characters.view(numpy.uint32).reshape(count, width)
+    expected = numpy.array([ord(character) for character in flowcell + ":"], dtype=numpy.uint32)
+    valid = (codes[:, :prefix] == expected).all(axis=1)
+    fields = numpy.zeros((4, count), dtype=numpy.uint64)
+    field = numpy.zeros(count, dtype=numpy.intp)
+    digits = numpy.zeros(count, dtype=numpy.intp)
+    leading_zero = numpy.zeros(count, dtype=bool)
+    current = numpy.zeros(count, dtype=numpy.uint64)
+    rows = numpy.arange(count)
+    for position in range(prefix, width):
+        column = codes[:, position]
+        is_digit = (column >= 48) & (column <= 57)
+        is_colon = column == 58
+        ## other characters, empty and zero-padded coordinates, a sixth field
+        valid &= is_digit | is_colon | (column == 0)
+        valid &= ~(is_digit & leading_zero) & ~(is_colon & ((digits == 0) | (field == 3)))
+        digit = valid & is_digit
+        current = numpy.where(digit, current * numpy.uint64(10) + (column - 48), current)
+        leading_zero |= digit & (digits == 0) & (column == 48)
+        digits += digit
+        valid &= digits <= MAX_DIGITS
+        colon = valid & is_colon
+        fields[field[colon], rows[colon]] = current[colon]
+        field += colon
+        current[colon], digits[colon], leading_zero[colon] = 0, 0, False
+    valid &= (field == 3) & (digits > 0)
+    lane, tile, x = fields[0], fields[1], fields[2]
+    y = current
+    valid &= ((lane >> numpy.uint64(LANE_BITS)) == 0) & ((tile >> numpy.uint64(TILE_BITS)) == 0)
+    valid &= ((x >> numpy.uint64(X_BITS)) == 0) & ((y >> numpy.uint64(Y_BITS)) == 0)
+    packed = ((((lane << numpy.uint64(TILE_BITS)) | tile) << numpy.uint64(X_BITS) | x)
+              << numpy.uint64(Y_BITS)) | y
+    keys[valid] = packed[valid]
+    return(valid)
+
+
+def pack_read_ids(codec, read_ids):
+    """Return the 64-bit keys of the read IDs of the list: packed like ReadKeyCodec.pack(),
+        hashed if they cannot be packed. Without a flowcell, the codec takes
+        the flowcell of the first read ID with five fields, as pack() does.
+    """
+    keys = numpy.zeros(len(read_ids), dtype=numpy.uint64)
+    if codec.flowcell is None:
+        for read_id in read_ids:
+            if read_id.count(":") == 4:
+                codec.flowcell = read_id.split(":", 1)[0]
+                break
+    if codec.flowcell is not None and read_ids:
+        packed = _pack_coordinates(codec.flowcell, read_ids, keys)
+    else:
+        packed = numpy.zeros(len(read_ids), dtype=bool)
+    for i in numpy.flatnonzero(~packed).tolist():
+        keys[i] = hash_read_id(read_ids[i])
+    return(keys)
+
+
+def _find_collisions(iter_read_cells, positions, keys, codes):
+    """Return {read ID: cell code} of the different read IDs sharing a hashed key;
+        positions are the positions of the repeated hashed keys in the input order,
+        the (read ID, cell ID) pairs are read again to find their read IDs
+    """
+    wanted = numpy.zeros(len(keys), dtype=bool)
+    wanted[positions] = True
+    key_read_ids = {}
+    start = 0
+    read_cells = iter_read_cells()
+    batch = list(islice(read_cells, PACK_BATCH_SIZE))
+    while batch:
+        for position in (start + numpy.flatnonzero(wanted[start:start + len(batch)])).tolist():
+            read_id = batch[position - start][0]
+            key = int(keys[position])
+            if hash_read_id(read_id) != key:
+                raise ReadIndexException("The read -- cell association changed while it was indexed.")
+            ## the first cell of a read ID stored several times is kept
+            key_read_ids.setdefault(key, {}).setdefault(read_id, int(codes[position]))
+        start += len(batch)
+        batch = list(islice(read_cells, PACK_BATCH_SIZE))
+    return({read_id: cell_code for read_ids in key_read_ids.values() if len(read_ids) > 1
+            for read_id, cell_code in read_ids.items()})
+
+
+def build_index(file_name, iter_read_cells):
+    """Write the index of the (read ID, cell ID) pairs yielded by iter_read_cells():
+        the sorted 64-bit read keys, the cell codes in the same order and a JSON
+        trailer with the flowcell, the cell IDs and the read IDs whose hashes collide.
+        The first cell of a read ID stored several times is kept. The pairs are
+        read again only if hashed keys repeat, to tell a read ID stored several
+        times from a collision.
+    """
+    require_numpy()
+    codec = ReadKeyCodec()
+    cell_codes = {}
+    key_batches, code_batches = [], []
+    read_cells = iter_read_cells()
+    batch = list(islice(read_cells, PACK_BATCH_SIZE))
+    while batch:
+        key_batches.append(pack_read_ids(codec, [read_id for read_id, _ in batch]))
+        code_batches.append(numpy.fromiter((cell_codes.setdefault(cell_id, len(cell_codes)) for _, cell_id in batch),
+                                           dtype=numpy.uint32, count=len(batch)))
+        batch = list(islice(read_cells, PACK_BATCH_SIZE))
+    if len(cell_codes) >= COLLISION_CODE:
+        raise ReadIndexException("Too many cells for the index.")
+    keys = numpy.concatenate(key_batches) if key_batches else numpy.zeros(0, dtype=numpy.uint64)
+    codes = numpy.concatenate(code_batches) if code_batches else numpy.zeros(0, dtype=numpy.uint32)
+    del key_batches, code_batches
+
+    order = numpy.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    first = numpy.ones(len(sorted_keys), dtype=bool)
+    first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    ## all the members of the runs of equal hashed keys
+    repeated = ~first
+    repeated[:-1] |= ~first[1:]
+    repeated &= sorted_keys >= numpy.uint64(HASHED_KEY_BIT)
+    collisions = {}
+    if repeated.any():
+        collisions = _find_collisions(iter_read_cells, order[repeated], keys, codes)
+    keys, codes = sorted_keys[first], codes[order[first]]
+    del order, sorted_keys
+    if collisions:
+        colliding_keys = numpy.array(sorted({hash_read_id(read_id) for read_id in collisions}), dtype=numpy.uint64)
+        codes[numpy.isin(keys, colliding_keys)] = COLLISION_CODE
+
+    trailer = json.dumps({"flowcell": codec.flowcell,
+                          "cells": sorted(cell_codes, key=cell_codes.get),
+                          "collisions": collisions}).encode("utf-8")
+    temp_file_name = file_name + ".tmp"
+    with open(temp_file_name, "wb") as f:
+        trailer_offset = _HEADER.size + 12 * len(keys)
+        f.write(_HEADER.pack(MAGIC, len(keys), trailer_offset, len(trailer)))
+        f.write(keys.astype("<u8").tobytes())
+        f.write(codes.astype("<u4").tobytes())
+        f.write(trailer)
+    os.replace(temp_file_name, file_name)
+    return(len(keys))
+
+
+def save_cell_samples(file_name, cell_samples):
+    """Save the {cell ID: sample} assignment next to the index,
+        it is rewritten whenever the cells are assigned again
+    """
+    temp_file_name = file_name + CELLS_FILE_SUFFIX + ".tmp"
+    with open(temp_file_name, "w") as f:
+        json.dump(cell_samples, f)
+    os.replace(temp_file_name, file_name + CELLS_FILE_SUFFIX)
+
+
+def remove_index(file_name):
+    """Delete the index and its cell assignment"""
+    for name in (file_name, file_name + CELLS_FILE_SUFFIX):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+class MmapReadIndex:
+    """Looks up the samples of read IDs in the memory-mapped index;
+        the whole batch is resolved by a vectorized binary search with numpy.
+        The pages are shared by all the processes mapping the file.
+        A key of a read ID missing from the index matches a stored key
+        only by a 64-bit hash collision, which is negligible.
+    """
+
+    file_name = None
+    count = 0
+
+    def __init__(self, file_name):
+        require_numpy()
+        self.file_name = file_name
+        try:
+            with open(file_name, "rb") as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with open(file_name + CELLS_FILE_SUFFIX) as f:
+                cell_samples = json.load(f)
+        except OSError as e:
+            raise ReadIndexException(f"Cannot open the read index {file_name}: {e}")
+        magic, self.count, trailer_offset, trailer_size = _HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ReadIndexException(f"Not a read index: {file_name}")
+        trailer = json.loads(self.mmap[trailer_offset:trailer_offset + trailer_size])
+        self.codec = ReadKeyCodec(trailer["flowcell"] if trailer["flowcell"] is not None else "")
+        self.code_samples = [cell_samples.get(cell_id) for cell_id in trailer["cells"]]
+        self.collisions = trailer["collisions"]
+        codes_offset = _HEADER.size + 8 * self.count
+        self.keys = numpy.frombuffer(self.mmap, dtype="<u8", count=self.count, offset=_HEADER.size)
+        self.codes = numpy.frombuffer(self.mmap, dtype="<u4", count=self.count, offset=codes_offset)
+
+    def get_multiple_read_sample_pairs(self, key_list):
+        """Return sample for read IDs provided in the argument"""
+        read_ids = list(key_list)
+        found = self._search(pack_read_ids(self.codec, read_ids))
+        code_samples, collisions = self.code_samples, self.collisions
+        result = {}
+        for i, code in found:
+            read_id = read_ids[i]
+            if code == COLLISION_CODE:
+                code = collisions.get(read_id)
+                if code is None:
+                    continue
+            sample = code_samples[code]
+            if sample is not None:
+                result[read_id] = sample
+        return(result)
+
+    def _search(self, keys):
+        """Return (position in the batch, cell code) of the keys found"""
+        if self.count == 0:
+            return([])
+        positions = numpy.searchsorted(self.keys, keys)
+        numpy.minimum(positions, self.count - 1, out=positions)
+        hits = numpy.flatnonzero(self.keys[positions] == keys)
+        return(zip(hits.tolist(), self.codes[positions[hits]].tolist()))
+
+    def close(self):
+        """Unmap the index"""
+        self.keys = self.codes = None
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                ## numpy arrays of a finished batch may still be referenced
+                pass
+            self.mmap = None
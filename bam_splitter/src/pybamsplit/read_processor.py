@@ -7,50 +7,81 @@ __email__ = "jan@hapala.cz"
 __status__ = "Production"
 
 import os, sys
+import shutil
+import tempfile
+import multiprocessing
 from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 #from tabulate import tabulate
-import gzip
-from .read_storage import SQLReadStorage, DatabaseException, get_timestamp
+from .read_storage import get_storage, DatabaseException, get_timestamp
+from .partitioned_storage import PartitionedReadStorage
+from .compression import OutputCompressor, COMPRESSION_LEVEL
+from .prefetch import PrefetchingReader, QUEUE_DEPTH
+from .stats import RunStats, sweep_thresholds
+from .output_manager import OutputManager, FLUSH_SIZE, MAX_OPEN_FILES
+from .fastq_parser import paired_batches, record_batches, FastqFormatException
+from .bam_reader import BamReader
+from .batch_writer import BatchWriter, MEMORY_BUDGET, record_size
+from .instrumentation import Instrumentation
+from .read_index import (MmapReadIndex, build_index, save_cell_samples, remove_index, require_numpy,
+                         INDEX_FILE_SUFFIX)
+from .sort_merge import MergedReadSamples, write_run, merge_runs, merge_join, RUN_SIZE
+from .bloom import (bloom_filter_for, load_bloom_filter, remove_bloom_filter,
+                    BLOOM_FILE_SUFFIX, FALSE_POSITIVE_RATE)
+from .bloom import require_numpy as require_bloom_numpy
 
 LINE_NR_PRINT = 1000000
-
-class NotReadIDException(Exception):
-    pass
+## outputs of the reads without a single sample, skipped on request
+UNASSIGNED_SAMPLES = {"UNDETERMINED", "MULTIPLE"}
+## in-memory storage loaded by the parent process, inherited by the forked lane workers
+_shared_storage = None
 
 class ReadProcessorException(Exception):
     pass
 
 
-def crop_read_id(read_id):
-    """Cuts off prefix of the read ID until the second ":"
+def fastq_pairs(reads1_files, reads2_files):
+    """Return the list of (reads1 file, reads2 file) lane pairs,
+        the arguments are single file names or lists of them
     """
-    cid = read_id.split(":", maxsplit=2)[2]
-    return(cid)
+    if isinstance(reads1_files, str):
+        reads1_files = [reads1_files]
+    if isinstance(reads2_files, str):
+        reads2_files = [reads2_files]
+    if not reads1_files or len(reads1_files) != len(reads2_files):
+        raise ReadProcessorException("ERROR: every reads1 FASTQ file needs its reads2 FASTQ file.")
+    return(list(zip(reads1_files, reads2_files)))
 
 
-class SeqRead:
-    """Structure for keeping a DNA read record
+def _retrieve_lane(options, out_dir, reads1_file, reads2_file, fastq_records_buffer_size):
+    """Split one lane pair into the output directory of the lane in a worker process,
+        the database is only read; return the statistics of the lane
     """
+    os.makedirs(out_dir, exist_ok=True)
+    processor = ReadProcessor(out_dir, **options)
+    if _shared_storage is not None:
+        ## the pages of the maps stay shared with the parent until they are written
+        processor.storage = _shared_storage
+    try:
+        with processor._open_fastq_files(reads1_file, reads2_file) as (f1, f2):
+            processor._retrieve(f1, f2, fastq_records_buffer_size)
+    finally:
+        with processor.instrumentation.timed("output close"):
+            processor.close_output_files()
+        processor.close_read_index()
+        processor.storage.close()
+    return({"lookups": processor.lookup_count,
+            "lookup_hits": processor.lookup_hit_count,
+            "written": processor.outputs.written,
+            "timings": processor.instrumentation.as_dict()})
 
-    record = ""
-    line_num = 0
 
-    def __init__(self, line_num, record):
-        self.record = record
-        self.line_num = line_num
-    
-    @property
-    def cid(self):
-        return crop_read_id(self.id)
-
-    @property
-    def id(self):
-        if not self.record.startswith(b"@"):
-            record_prefix = f"{str(self.record[:min(50, len(self.record))])}..." 
-            raise NotReadIDException("Error: Read ID was not found in the line:", record_prefix) 
-        read_id = self.record.split(maxsplit=1)[0][1:].decode("ascii").strip()
-        #read_id = self.record.split(maxsplit=1)[0][1:]
-        return(read_id)
+def crop_read_id(read_id):
+    """Cuts off prefix of the read ID until the second ":"
+    """
+    cid = read_id.split(":", maxsplit=2)[2]
+    return(cid)
 
 
 class ReadProcessor:
@@ -60,115 +91,347 @@ class ReadProcessor:
 
     storage = None
     read_sample_lines_dict = defaultdict(list)
-    output_files = {}
+    outputs = None
     out_dir = ""
     minimumSampleAssociationThreshold = None
+    compressor = None
+    prefetch_depth = QUEUE_DEPTH
+    stats = None
+    lookup_count = 0
+    lookup_hit_count = 0
+    instrumentation = None
+    options = None
+    mmap_index = False
+    index_file = None
+    read_index = None
+    bloom = False
+    bloom_fp_rate = FALSE_POSITIVE_RATE
+    bloom_file = None
+    bloom_filter = None
+    samples = None
+    skip_unassigned = False
+    output_samples = None
+    skipped_samples = frozenset()
+    ## the samples kept by process, the Bloom filter holds only their reads
+    selected_samples = None
 
-    def __init__(self, out_dir, db_file, threshold = None):
+    def __init__(self, out_dir, db_file, threshold = None, backend = "sqlite",
+                 compression_threads = 1, compression_level = COMPRESSION_LEVEL,
+                 prefetch_depth = QUEUE_DEPTH, partitions = 1,
+                 flush_size = FLUSH_SIZE, max_open_files = MAX_OPEN_FILES, blocked_output = False,
+                 mmap_index = False, bloom = False, bloom_fp_rate = FALSE_POSITIVE_RATE,
+                 samples = None, skip_unassigned = False):
         self.out_dir = out_dir
-        self.storage = SQLReadStorage(db_file)
+        ## everything but the output directory, for the worker processes
+        self.options = {"db_file": db_file, "threshold": threshold, "backend": backend,
+                        "compression_threads": compression_threads, "compression_level": compression_level,
+                        "prefetch_depth": prefetch_depth, "partitions": partitions, "flush_size": flush_size,
+                        "max_open_files": max_open_files, "blocked_output": blocked_output,
+                        "mmap_index": mmap_index, "bloom": bloom, "bloom_fp_rate": bloom_fp_rate,
+                        "samples": samples, "skip_unassigned": skip_unassigned}
+        if partitions > 1:
+            self.storage = PartitionedReadStorage(backend, db_file, partitions)
+        else:
+            self.storage = get_storage(backend, db_file)
         self.minimumSampleAssociationThreshold = threshold
+        self.compressor = OutputCompressor(compression_threads, compression_level, blocked_output)
+        self.outputs = OutputManager(out_dir, self.compressor, flush_size, max_open_files)
+        self.prefetch_depth = prefetch_depth
+        self.stats = RunStats(out_dir)
+        self.instrumentation = Instrumentation()
+        self.storage.set_instrumentation(self.instrumentation)
+        ## fail before the work whose index or filter could not be built or searched
+        if mmap_index:
+            require_numpy()
+        if bloom:
+            require_bloom_numpy()
+        self.mmap_index = mmap_index
+        self.index_file = db_file + INDEX_FILE_SUFFIX
+        self.bloom = bloom
+        self.bloom_fp_rate = bloom_fp_rate
+        self.bloom_file = db_file + BLOOM_FILE_SUFFIX
+        self.samples = sorted(set(samples)) if samples else None
+        self.skip_unassigned = skip_unassigned
 
-    def open_new_files(self, sample):
-        """Open pair read output FASTQ files for the specified sample"""
-        out_file1 = gzip.open(self.out_dir + "/" + sample + "_reads1.fastq.gz", 'wb')
-        out_file2 = gzip.open(self.out_dir + "/" + sample + "_reads2.fastq.gz", 'wb')
-        self.output_files[sample] = (out_file1, out_file2)
-    
-    def get_output_files(self, sample):
-        """Return output file corresponding to the argument; open a new file if not existing"""
-        if sample not in self.output_files:
-            self.open_new_files(sample)
-        return(self.output_files[sample])
-    
     def close_output_files(self):
-        """Close the pair read FASTQ output files"""
-        for (of1, of2) in self.output_files.values():
-            of1.close()
-            of2.close()
+        """Write the buffered reads and close the pair read FASTQ output files"""
+        self.outputs.close()
+        self.compressor.shutdown()
     
-    def retrieve(self, reads1_file, reads2_file, fastq_records_buffer_size, do_not_delete_db=False):
+    def retrieve(self, reads1_files, reads2_files, fastq_records_buffer_size, do_not_delete_db=False, jobs=None):
         """Read the input pair read FASTQ files and split reads with the
             information collected in the temporary database, built from the 
-            corresponding BAM files
+            corresponding BAM files.
+            Several lane pairs are split in a pool of jobs worker processes
+            (by default one per lane, at most one per CPU) and their outputs are
+            concatenated; with a single job they are split one after another.
+            The workers share an in-memory database loaded once by this process;
+            where processes cannot be forked the lanes are split in this process,
+            unless the reads are looked up in the memory-mapped index.
         """
+        pairs = fastq_pairs(reads1_files, reads2_files)
+        jobs = min(len(pairs), jobs or os.cpu_count() or 1)
+        if (jobs > 1 and self.storage.in_memory and not self.mmap_index
+                and "fork" not in multiprocessing.get_all_start_methods()):
+            ## every worker would load its own copy of the in-memory database
+            jobs = 1
+        ## an invalid selection fails before the lanes are started and the database is deleted
+        self._select_outputs()
+        completed = False
         try:
-            self._retrieve(reads1_file, reads2_file, fastq_records_buffer_size, do_not_delete_db)
+            if jobs > 1:
+                self._retrieve_lanes(pairs, fastq_records_buffer_size, jobs)
+            else:
+                for reads1_file, reads2_file in pairs:
+                    with self._open_fastq_files(reads1_file, reads2_file) as (f1, f2):
+                        self._retrieve(f1, f2, fastq_records_buffer_size)
+            completed = True
         except Exception as e:
             raise e
         finally:
-            self.close_output_files()
+            with self.instrumentation.timed("output close"):
+                self.close_output_files()
+            self.close_read_index()
+            if completed:
+                self._report_stages()
+                self._save_retrieve_stats()
             if do_not_delete_db:
                 print(f"{get_timestamp()}    Temporary database left. Should be deleted.")
             else:
                 self.cleanup()
 
-    def _retrieve(self, reads1_file, reads2_file, fastq_records_buffer_size, do_not_delete_db):
-        """Read the input pair read FASTQ files and split reads with the
-            information collected in the temporary database, built from the 
+    def _retrieve_lanes(self, pairs, fastq_records_buffer_size, jobs):
+        """Split every lane pair into its own directory in the worker processes,
+            then join the per-sample outputs of the lanes in the lane order.
+            An in-memory storage is loaded once here and the workers are forked,
+            so that they share it instead of loading a copy each; with the
+            memory-mapped index the workers load only the small cell maps
+            and share the pages of the index.
+        """
+        global _shared_storage
+        mp_context = None
+        ## the lookups of the memory-mapped index do not touch the read map
+        if self.storage.in_memory and not self.mmap_index:
+            print(f"{get_timestamp()}    Loading the in-memory database shared by the processes.", flush=True)
+            with self.instrumentation.timed("database load"):
+                self.storage.load()
+            _shared_storage, mp_context = self.storage, multiprocessing.get_context("fork")
+        lane_dirs = [os.path.join(self.out_dir, f".lane{lane}") for lane in range(len(pairs))]
+        print(f"{get_timestamp()}    Splitting {len(pairs)} lane pairs in {jobs} processes.", flush=True)
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context) as executor:
+                futures = [executor.submit(_retrieve_lane, self.options, lane_dir, reads1_file, reads2_file,
+                                           fastq_records_buffer_size)
+                           for lane_dir, (reads1_file, reads2_file) in zip(lane_dirs, pairs)]
+                results = [future.result() for future in futures]
+            with self.instrumentation.timed("lane concatenation"):
+                self._concatenate_lanes(lane_dirs, results)
+        finally:
+            _shared_storage = None
+            for lane_dir in lane_dirs:
+                shutil.rmtree(lane_dir, ignore_errors=True)
+
+    def _concatenate_lanes(self, lane_dirs, results):
+        """Join the compressed per-sample outputs of the lanes without recompressing,
+            add up the statistics of the lanes
+        """
+        written = self.outputs.written
+        for result in results:
+            self.lookup_count += result["lookups"]
+            self.lookup_hit_count += result["lookup_hits"]
+            self.instrumentation.merge(result["timings"])
+            for sample, (read_pairs, size) in result["written"].items():
+                sample_written = written.setdefault(sample, [0, 0])
+                sample_written[0] += read_pairs
+                sample_written[1] += size
+                self.outputs.bytes_written += size
+        for sample in written:
+            for file_name in self.outputs.file_names(sample):
+                lane_file_names = [os.path.join(lane_dir, os.path.basename(file_name)) for lane_dir in lane_dirs]
+                self.compressor.concatenate([name for name in lane_file_names if os.path.exists(name)], file_name)
+
+    def split(self, reads1_files, reads2_files, fastq_records_buffer_size, records_buffer_size=None,
+              bam_file=None, threads=1, memory_budget=MEMORY_BUDGET, calc_stats=False,
+              do_not_delete_db=False, input_stream=None):
+        """Build, process and retrieve in one process: collect the alignments,
+            assign the cells to samples and split the FASTQ reads straight away,
+            without saving the storage between the steps and dropping its intermediate
+            tables. The (first) FASTQ files start being decompressed while the alignments
+            are collected; several lane pairs are split one after another.
+            Unless the database is to be left, the storage need not be saved.
+        """
+        pairs = fastq_pairs(reads1_files, reads2_files)
+        self.storage.persistent = do_not_delete_db
+        completed = False
+        try:
+            with self._open_fastq_files(*pairs[0]) as (f1, f2):
+                try:
+                    build_stats = self._collect_reads(records_buffer_size, bam_file, threads, memory_budget,
+                                                      input_stream)
+                    self.storage.commit()
+                except Exception as e:
+                    raise ReadProcessorException("Error while writing to the database.", e)
+                self.stats.save("build", build_stats)
+                _, _, process_stats = self._assign_samples(calc_stats)
+                if self.mmap_index:
+                    self._export_index()
+                if self.bloom and not self.storage.sequential:
+                    process_stats["bloom_filter"] = self._export_bloom_filter(process_stats["selected_reads"])
+                process_stats["timings"] = self.instrumentation.as_dict()
+                self.stats.save("process", process_stats)
+                self._retrieve(f1, f2, fastq_records_buffer_size)
+            for reads1_file, reads2_file in pairs[1:]:
+                with self._open_fastq_files(reads1_file, reads2_file) as (f1, f2):
+                    self._retrieve(f1, f2, fastq_records_buffer_size)
+            completed = True
+        finally:
+            with self.instrumentation.timed("output close"):
+                self.close_output_files()
+            self.close_read_index()
+            if completed:
+                self._report_stages()
+                self._save_retrieve_stats()
+            self.storage.close()
+            if self.storage.persistent:
+                print(f"{get_timestamp()}    Temporary database left. Should be deleted.")
+            else:
+                self.cleanup()
+
+    @contextmanager
+    def _open_fastq_files(self, reads1_file, reads2_file):
+        """Start decompressing the pair read FASTQ files on background threads"""
+        with PrefetchingReader(reads1_file, queue_depth=self.prefetch_depth) as f1, \
+                PrefetchingReader(reads2_file, queue_depth=self.prefetch_depth) as f2:
+            yield(f1, f2)
+
+    def _retrieve(self, f1, f2, fastq_records_buffer_size):
+        """Read the pair read FASTQ files from the prefetching readers and split reads
+            with the information collected in the temporary database, built from the
             corresponding BAM files
         """
         reads_buffer = dict()
-    
-        read1, read2 = None, None
-        with gzip.open(reads1_file, 'rb') as f1, gzip.open(reads2_file, 'rb') as f2:
-    
-            for line_counter, (r1_line, r2_line) in enumerate(zip(f1, f2)):
-                if line_counter % 4 == 0:
-                    try:
-                        if read1 is None: ## starting the first read in the file
-                            read1, read2 = SeqRead(line_counter, r1_line), SeqRead(line_counter, r2_line)
-                            if read1.id != read2.id:
-                                raise ReadProcessorException(
-                                    f"""ERROR: The fastq files are not organized in the same 
-                                        order, line {str(line_counter)}, read1 ID: {read1.id.decode("ascii")}, 
-                                        read2 ID: {read2.id.decode("ascii")}.""")
-                        else: ## starting a new read, process the previous one
-                            self._add_previous_read(reads_buffer, read1, read2)
-                            if len(reads_buffer) >= fastq_records_buffer_size:
-                                self._process_buffer(reads_buffer)
-                            read1, read2 = SeqRead(line_counter, r1_line), SeqRead(line_counter, r2_line)
-                    except NotReadIDException:
-                        raise ReadProcessorException(
-                            f"""ERROR: Problem encountered while reading the FASTQ files,
-                            read ID expected, not found: line {line_counter},
-                            read1: {read1.record.decode("ascii")},\n\t\t\t\t
-                            read2: {read2.record.decode("ascii")}.""")
-
-                    if (line_counter / 4) % LINE_NR_PRINT == 0 and line_counter > 0:
-                        print(f"{get_timestamp()}   Reading read nr. { '{:,}'.format(int(line_counter / 4) ) }...", flush=True)
-
-                else: # add to the current read
-                    read1.record += r1_line
-                    read2.record += r2_line
-            ## process last reads
-            if line_counter > 0:
-                print(f"{get_timestamp()}    Read { '{:,}'.format(int(line_counter / 4) ) } reads altogether...", flush=True)
-            if line_counter < 1:
-                raise ReadProcessorException("Input FASTQ file(s) is/are empty.")
-            self._add_previous_read(reads_buffer, read1, read2)
+        read_counter = 0
+        instrumentation = self.instrumentation
+        self._select_outputs()
+        if self.mmap_index and self.read_index is None:
+            self.read_index = MmapReadIndex(self.index_file)
+            print(f"{get_timestamp()}    Looking up the reads in the memory-mapped index of "
+                  f"{ '{:,}'.format(self.read_index.count) } reads.", flush=True)
+        if self.storage.sequential and self.read_index is None:
+            self._retrieve_merge_join(f1, f2, fastq_records_buffer_size)
+            return
+        if self.bloom and self.bloom_filter is None and not self.storage.sequential:
+            self.bloom_filter = load_bloom_filter(self.bloom_file)
+            print(f"{get_timestamp()}    Screening the reads with the Bloom filter of "
+                  f"{ '{:,}'.format(self.bloom_filter.count) } reads.", flush=True)
+
+        try:
+            ## the parsing time includes waiting for the prefetch threads to inflate the input
+            batches = instrumentation.timed_iter("parse", paired_batches(f1.chunks(), f2.chunks()))
+            for read_ids, records1, records2 in batches:
+                start = 0
+                while start < len(read_ids):
+                    end = start + fastq_records_buffer_size - len(reads_buffer)
+                    reads_buffer.update(zip(read_ids[start:end], zip(records1[start:end], records2[start:end])))
+                    start = end
+                    if len(reads_buffer) >= fastq_records_buffer_size:
+                        self._process_buffer(reads_buffer)
+                if (read_counter + len(read_ids)) // LINE_NR_PRINT > read_counter // LINE_NR_PRINT:
+                    throughput = instrumentation.progress(read_counter + len(read_ids),
+                                                          f1.bytes_in + f2.bytes_in, self.outputs.bytes_written)
+                    print(f"{get_timestamp()}   Reading read nr. { '{:,}'.format(read_counter + len(read_ids)) }... ({throughput})", flush=True)
+                read_counter += len(read_ids)
+        except FastqFormatException as e:
+            raise ReadProcessorException(
+                f"""ERROR: Problem encountered while reading the FASTQ files: {e}""")
+        finally:
+            instrumentation.add_time("inflate (prefetch)", f1.inflate_time + f2.inflate_time, 0)
+            instrumentation.add_time("inflate wait", f1.wait_time + f2.wait_time, 0)
+            instrumentation.count("input compressed bytes", f1.bytes_in + f2.bytes_in)
+            instrumentation.count("input bytes", f1.bytes_out + f2.bytes_out)
+        ## process last reads
+        if read_counter < 1:
+            raise ReadProcessorException("Input FASTQ file(s) is/are empty.")
+        print(f"{get_timestamp()}    Read { '{:,}'.format(read_counter) } reads altogether...", flush=True)
+        if reads_buffer:
             self._process_buffer(reads_buffer)
-    
-    def read_and_store(self, records_buffer_size):
-        """Read input BAM file, extract read IDs and corresponding cell IDs and sample tag
-            and store them in a database.
+
+    def _retrieve_merge_join(self, f1, f2, fastq_records_buffer_size):
+        """Split the reads with a merge join instead of the lookups: spill sorted
+            runs of the read IDs with their record numbers, join them with the sorted
+            association of the storage, spill the hits sorted by the record number
+            and read the FASTQ files again, taking the samples of the reads in order
         """
-        records = []
-    
+        with tempfile.TemporaryDirectory(prefix=".merge_join.", dir=self.out_dir) as temp_dir:
+            hit_runs = self._join_read_ids(f1, temp_dir)
+            hits = merge_runs(hit_runs, os.path.join(temp_dir, "hits_merge"), key=lambda row: int(row[0]))
+            self.read_index = MergedReadSamples(hits)
+            try:
+                with self._open_fastq_files(f1.file_name, f2.file_name) as (f1_again, f2_again):
+                    self._retrieve(f1_again, f2_again, fastq_records_buffer_size)
+            finally:
+                self.close_read_index()
+
+    def _join_read_ids(self, f1, temp_dir):
+        """Spill the sorted runs of (read ID, record number) of the reads1 FASTQ file,
+            merge-join them with the association and return the run files of the
+            (record number, read ID, sample) hits, sorted by the record number
+        """
+        instrumentation = self.instrumentation
+        read_counter = 0
+        read_ids, key_runs = [], []
         try:
-            self.storage.setup()
-            for line_counter, line in enumerate(sys.stdin):
-                line = line.rstrip()
-                self._store(line, records)
-                if line_counter % LINE_NR_PRINT == 0 and line_counter > 0:
-                    print(f"{get_timestamp()}   { '{:,}'.format(line_counter) } reads collected.", flush=True)
+            for batch_ids, _ in instrumentation.timed_iter("parse", record_batches(f1.chunks())):
+                read_ids.extend(zip(batch_ids, range(read_counter, read_counter + len(batch_ids))))
+                read_counter += len(batch_ids)
+                if len(read_ids) >= RUN_SIZE:
+                    with instrumentation.timed("spill read ID runs"):
+                        read_ids.sort()
+                        key_runs.append(write_run(os.path.join(temp_dir, f"keys{len(key_runs)}"), read_ids))
+                    read_ids = []
+        except FastqFormatException as e:
+            raise ReadProcessorException(
+                f"""ERROR: Problem encountered while reading the FASTQ files: {e}""")
+        finally:
+            instrumentation.add_time("inflate (prefetch)", f1.inflate_time, 0)
+            instrumentation.add_time("inflate wait", f1.wait_time, 0)
+        with instrumentation.timed("spill read ID runs"):
+            read_ids.sort()
+            key_runs.append(write_run(os.path.join(temp_dir, f"keys{len(key_runs)}"), read_ids))
+        print(f"{get_timestamp()}    Sorted { '{:,}'.format(read_counter) } read IDs into {len(key_runs)} runs, "
+              f"joining them with the reads in the database.", flush=True)
 
-                if line_counter >= records_buffer_size:
-                    self.storage.store(records)
+        cell_samples = self.storage.get_cell_samples()
+        hits, hit_runs = [], []
+        with instrumentation.timed("merge join"):
+            read_id_rows = merge_runs(key_runs, os.path.join(temp_dir, "keys_merge"))
+            for (read_id, record_number), (_, cell_id) in merge_join(read_id_rows, self.storage.iter_read_cells()):
+                sample = cell_samples.get(cell_id)
+                ## the reads of the samples not written stay out of the second pass
+                if sample is not None and self._is_written(sample):
+                    hits.append((int(record_number), read_id, sample))
+                    if len(hits) >= RUN_SIZE:
+                        hits.sort()
+                        hit_runs.append(write_run(os.path.join(temp_dir, f"hits{len(hit_runs)}"), hits))
+                        hits = []
+            hits.sort()
+            hit_runs.append(write_run(os.path.join(temp_dir, f"hits{len(hit_runs)}"), hits))
+        for key_run in key_runs:
+            os.remove(key_run)
+        return(hit_runs)
 
-            print(f"{get_timestamp()}    { '{:,}'.format(line_counter) } reads collected.")
-            print(f"{get_timestamp()}    Saving reads to a temporary local database.", flush=True)
-            self.storage.store(records)
+    def read_and_store(self, records_buffer_size=None, bam_file=None, threads=1, memory_budget=MEMORY_BUDGET,
+                       input_stream=None):
+        """Read input BAM file, extract read IDs and corresponding cell IDs and sample tag
+            and store them in a database. Without the BAM file, the fields
+            extracted by extract_fields.mawk are read from the input stream
+            (the standard input by default).
+            The records are stored on a writer thread in batches fitting in the
+            memory budget (bytes), optionally limited also by the number of records.
+        """
+        try:
+            build_stats = self._collect_reads(records_buffer_size, bam_file, threads, memory_budget, input_stream)
+            self._report_stages()
         except Exception as e:
             raise ReadProcessorException("Error while writing to the database.", e)
         else:
@@ -177,18 +440,102 @@ class ReadProcessor:
             #self.storage.create_indexes()
         finally:
             self.storage.close()
-    
-    def process_db(self, calc_stats):
+        self.stats.save("build", build_stats)
+
+    def _collect_reads(self, records_buffer_size, bam_file, threads, memory_budget, input_stream):
+        """Store the read ID, cell ID and sample tag of every alignment from the BAM file
+            or from the input stream in the storage, return the build statistics
+        """
+        records = []
+        records_bytes = 0
+        line_counter = 0
+
+        self.storage.setup()
+        ## an index or a filter exported from the previous database would not match the new one
+        remove_index(self.index_file)
+        remove_bloom_filter(self.bloom_file)
+        writer = BatchWriter(self.storage.store)
+        batch_size_limit = writer.batch_size_limit(memory_budget)
+        try:
+            if bam_file is None:
+                cell_reads = map(str.split, input_stream if input_stream is not None else sys.stdin)
+            else:
+                cell_reads = BamReader(bam_file, threads).cell_reads()
+            for line_counter, (read_id, cell_id, sample_name) in enumerate(cell_reads, 1):
+                if self._store(read_id, cell_id, sample_name, records):
+                    records_bytes += record_size(records[-1])
+                if line_counter % LINE_NR_PRINT == 0:
+                    print(f"{get_timestamp()}   { '{:,}'.format(line_counter) } reads collected.", flush=True)
+
+                if records_bytes >= batch_size_limit or (records_buffer_size is not None
+                                                         and len(records) >= records_buffer_size):
+                    writer.put(records)
+                    records, records_bytes = [], 0
+
+            print(f"{get_timestamp()}    { '{:,}'.format(line_counter) } reads collected.")
+            print(f"{get_timestamp()}    Saving reads to a temporary local database.", flush=True)
+            writer.put(records)
+        finally:
+            writer.close()
+        print(f"{get_timestamp()}    {writer.report()}.", flush=True)
+        self.instrumentation.add_time("insert (writer)", writer.store_time, writer.batches_stored)
+        self.instrumentation.add_time("parse wait for writer", writer.producer_stall_time, 0)
+        self.instrumentation.count("alignments", line_counter)
+        self.instrumentation.count("records stored", writer.records_stored)
+        return({"alignments": line_counter,
+                "records_stored": writer.records_stored,
+                "insert_seconds": round(writer.store_time, 3),
+                "timings": self.instrumentation.as_dict()})
+
+    def process_db(self, calc_stats, sweep=None):
         """Process the information stored in the database,
             reads from a cell (sharing the cell ID) might be assigned different sample tags,
             thus assign to each cell ID exactly one sample tag, using a threshold,
             produce final read ID -- sample tag association table.
+            Running it again on the same database only re-assigns the cells.
+            With a list of thresholds in sweep, report the cells per sample at each of them.
+        """
+        total_cell_count, cell_count_per_sample, process_stats = self._assign_samples(calc_stats)
+        if self.mmap_index:
+            self._export_index()
+        ## the merge join of the sequential storage has no lookups to screen
+        if self.bloom and not self.storage.sequential:
+            process_stats["bloom_filter"] = self._export_bloom_filter(process_stats["selected_reads"])
+        if sweep:
+            with self.instrumentation.timed("threshold sweep"):
+                self._sweep_thresholds(sweep)
+        with self.instrumentation.timed("cleanup"):
+            self.storage.cleanup()
+        self.storage.close()
+        self._report_stages()
+        process_stats["timings"] = self.instrumentation.as_dict()
+        self.stats.save("process", process_stats)
+        return(total_cell_count, cell_count_per_sample)
+
+    def _assign_samples(self, calc_stats):
+        """Assign a sample to every cell and create the association table,
+            print the statistical report if requested;
+            return the total cell count, the cell count per sample and the statistics
         """
-        self.storage.process_data(self.minimumSampleAssociationThreshold)
-        total_cell_count, cell_count_per_sample = None, None
+        with self.instrumentation.timed("process data"):
+            self.storage.process_data(self.minimumSampleAssociationThreshold, self.samples)
+        sample_summary = self.storage.get_sample_summary()
+        total_cell_count = sum(summary["cells"] for summary in sample_summary.values())
+        cell_count_per_sample = sorted((sample, summary["cells"]) for sample, summary in sample_summary.items())
+        process_stats = {"threshold": self.minimumSampleAssociationThreshold,
+                         "cells": total_cell_count,
+                         "reads": sum(summary["reads"] for summary in sample_summary.values()),
+                         "samples": sample_summary}
+        process_stats["selected_samples"] = self.samples
+        process_stats["selected_reads"] = process_stats["reads"]
+        if self.samples is not None:
+            process_stats["selected_reads"] = sum(sample_summary[sample]["reads"]
+                                                  for sample in self.samples if sample in sample_summary)
+            missing_samples = [sample for sample in self.samples if sample not in sample_summary]
+            if missing_samples:
+                print(f"{get_timestamp()}    WARNING: no cells were assigned to the selected samples: "
+                      f"{', '.join(missing_samples)}.", flush=True)
         if calc_stats:
-            total_cell_count = self.storage.get_total_cell_count()
-            cell_count_per_sample = self.storage.get_cell_count_per_sample()
             print("""\n\t\t\t**************************************************
                     \t**************  STATISTICAL REPORT  **************
                     \t**************************************************""")
@@ -204,55 +551,186 @@ class ReadProcessor:
             print("""\t\t\t**************************************************
             \t\t**************************************************
             \t\t**************************************************\n""", flush=True)
-        self.storage.cleanup()
-        self.storage.close()
-        return(total_cell_count, cell_count_per_sample)
+        return(total_cell_count, cell_count_per_sample, process_stats)
+
+    def _sweep_thresholds(self, thresholds):
+        """Print and save the cell count per sample at each of the thresholds"""
+        sweep = sweep_thresholds(self.storage.get_cell_sample_counts(), sorted(thresholds))
+        samples = sorted({sample for cells in sweep.values() for sample in cells} - {"MULTIPLE"}) + ["MULTIPLE"]
+        print(f"\n\t\t\tCell number per sample by threshold:")
+        sweep_tab_string = "\n\t\t\t%11s" % "THRESHOLD |" + "".join("%16s" % sample for sample in samples)
+        sweep_tab_string += "\n\t\t\t" + "-" * (11 + 16 * len(samples)) + "\n"
+        sweep_tab_string += "\n".join(["\t\t\t%11s" % (f"{threshold:g} |")
+                                        + "".join("%16s" % "{:,d}".format(cells.get(sample, 0)) for sample in samples)
+                                        for threshold, cells in sweep.items()])
+        print(f"{sweep_tab_string}\n", flush=True)
+        self.stats.save("sweep", {str(threshold): cells for threshold, cells in sweep.items()})
+
+    def _export_index(self):
+        """Write the read -- cell association into the memory-mapped index for retrieve;
+            it does not change when the cells are re-assigned, so only the cell
+            assignment saved next to it is rewritten if the index exists
+        """
+        with self.instrumentation.timed("index export"):
+            if not os.path.exists(self.index_file):
+                print(f"{get_timestamp()}    Exporting the read index.", flush=True)
+                count = build_index(self.index_file, self.storage.iter_read_cells)
+                print(f"{get_timestamp()}    { '{:,}'.format(count) } reads indexed.", flush=True)
+            save_cell_samples(self.index_file, self.storage.get_cell_samples())
+
+    def _export_bloom_filter(self, capacity):
+        """Write the Bloom filter of the associated read IDs for retrieve, sized for capacity
+            reads (the stored records, an upper bound of the read IDs); with a selection
+            of samples only their reads are added, so the others skip the lookups too.
+            Return the size and the false-positive rate of the filter.
+        """
+        with self.instrumentation.timed("bloom filter"):
+            read_cells = self.storage.iter_read_cells()
+            if self.samples is None:
+                read_ids = (read_id for read_id, _ in read_cells)
+            else:
+                cell_samples, samples = self.storage.get_cell_samples(), set(self.samples)
+                read_ids = (read_id for read_id, cell_id in read_cells if cell_samples.get(cell_id) in samples)
+            bloom_filter = bloom_filter_for(capacity, self.bloom_fp_rate)
+            bloom_filter.update(read_ids)
+            bloom_filter.save(self.bloom_file)
+        summary = {"reads": bloom_filter.count,
+                   "bytes": bloom_filter.size,
+                   "hashes": bloom_filter.hashes,
+                   "false_positive_rate": bloom_filter.false_positive_rate()}
+        print(f"{get_timestamp()}    Bloom filter of { '{:,}'.format(summary['reads']) } reads: "
+              f"{summary['bytes'] / 1024:,.0f} KB, {summary['hashes']} hashes, "
+              f"expected false-positive rate {summary['false_positive_rate']:.4f}.", flush=True)
+        return(summary)
+
+    def close_read_index(self):
+        """Unmap the read index if it was used"""
+        if self.read_index is not None:
+            self.read_index.close()
+            self.read_index = None
 
     def cleanup(self):
-        """Remove the temporary database"""
+        """Remove the temporary database and the read index"""
         print(f"{get_timestamp()}    Deleting temporary files.")
         self.storage.remove_db()
+        remove_index(self.index_file)
+        remove_bloom_filter(self.bloom_file)
+
+    def _select_outputs(self):
+        """Decide which samples are written: the selected ones (given, or recorded by process)
+            and, on request, not UNDETERMINED and MULTIPLE. With a selection, the dropped
+            reads cannot be told from the undetermined ones, so UNDETERMINED is skipped too.
+            The given samples must have been kept by process, the reads of the others were dropped.
+        """
+        samples = selected_samples = self.storage.get_selected_samples()
+        self.selected_samples = frozenset(selected_samples) if selected_samples is not None else None
+        if self.samples is not None:
+            missing = set(self.samples) - set(selected_samples) if selected_samples is not None else set()
+            if missing:
+                raise ReadProcessorException(
+                    f"ERROR: the reads of {', '.join(sorted(missing))} were dropped by process, which kept "
+                    f"only {', '.join(sorted(selected_samples))}.")
+            samples = self.samples
+        self.skipped_samples = frozenset(UNASSIGNED_SAMPLES if self.skip_unassigned
+                                         else {"UNDETERMINED"} if samples is not None else ())
+        self.output_samples = frozenset(samples) - self.skipped_samples if samples is not None else None
+
+    def _is_written(self, sample):
+        """Return True if the reads of the sample are written"""
+        return(sample not in self.skipped_samples
+               and (self.output_samples is None or sample in self.output_samples))
 
     def _write_reads(self, reads_buffer, id_sample_pairs):
-        """Write reads in the buffer into the correct output files"""
+        """Write reads in the buffer into the correct output files,
+            the reads of the samples not selected are dropped before compression
+        """
         reads_to_write = {1: defaultdict(list), 2: defaultdict(list)}
+        selective = self.output_samples is not None or bool(self.skipped_samples)
+        skipped = 0
 
         for read_id in reads_buffer.keys():
             read1, read2 = reads_buffer[read_id]
             sample = "UNDETERMINED"
             if read_id in id_sample_pairs:
                 sample = id_sample_pairs[read_id]
-            reads_to_write[1][sample].append(read1.record)
-            reads_to_write[2][sample].append(read2.record)
+            if selective and not self._is_written(sample):
+                skipped += 1
+                continue
+            reads_to_write[1][sample].append(read1)
+            reads_to_write[2][sample].append(read2)
 
-        blocks_to_write = {}
-        blocks_to_write[1] = { key : b"".join(val) for key, val in reads_to_write[1].items() }
-        blocks_to_write[2] = { key : b"".join(val) for key, val in reads_to_write[2].items() }
-        
-        for sample in blocks_to_write[1].keys():
-            ofile1, ofile2 = self.get_output_files(sample)
-            ofile1.write(blocks_to_write[1][sample])
-            ofile2.write(blocks_to_write[2][sample])
+        for sample in reads_to_write[1].keys():
+            self.outputs.write(sample, reads_to_write[1][sample], reads_to_write[2][sample])
+        if skipped:
+            self.instrumentation.count("read pairs skipped", skipped)
 
-    def _add_previous_read(self, reads_buffer, read1, read2):
-        """Upon finishing reading a read, add it to the buffer."""
-        cropped_id = read1.cid
-        reads_buffer[cropped_id] = (read1, read2)
+    def _report_stages(self):
+        """Print the time spent per stage"""
+        print(f"{get_timestamp()}    Time per stage:\n{self.instrumentation.report()}", flush=True)
+
+    def _save_retrieve_stats(self):
+        """Save the statistics on the written reads"""
+        written_summary = self.outputs.get_written_summary()
+        read_pairs = sum(summary["read_pairs"] for summary in written_summary.values())
+        undetermined = written_summary.get("UNDETERMINED", {}).get("read_pairs", 0)
+        counters = self.instrumentation.counters
+        bloom_screen = None
+        if "bloom screened" in counters:
+            screened, passed = counters["bloom screened"], counters["bloom passed"]
+            false_positives = counters.get("bloom false positives", 0)
+            ## the filter has no false negatives, so every read it holds passed it
+            misses = screened - (passed - false_positives)
+            bloom_screen = {"screened": screened,
+                            "passed": passed,
+                            "false_positives": false_positives,
+                            "false_positive_rate": false_positives / misses if misses else None}
+            print(f"{get_timestamp()}    Bloom filter passed { '{:,}'.format(passed) } of "
+                  f"{ '{:,}'.format(screened) } reads to the lookups, "
+                  f"{ '{:,}'.format(false_positives) } false positives.", flush=True)
+        self.stats.save("retrieve", {"read_pairs": read_pairs,
+                                     "lookups": self.lookup_count,
+                                     "lookup_hits": self.lookup_hit_count,
+                                     "lookup_hit_rate": self.lookup_hit_count / self.lookup_count if self.lookup_count else None,
+                                     "undetermined_share": undetermined / read_pairs if read_pairs else None,
+                                     "skipped_read_pairs": counters.get("read pairs skipped", 0),
+                                     "samples": written_summary,
+                                     "bloom_screen": bloom_screen,
+                                     "timings": self.instrumentation.as_dict()})
 
     def _process_buffer(self, reads_buffer):
         """Find in the database sample corresponding for each read in the buffer"""
         keys = reads_buffer.keys()
-        id_sample_pairs = self.storage.get_multiple_read_sample_pairs(keys)
-        self._write_reads(reads_buffer, id_sample_pairs)
+        lookup_keys = keys
+        if self.bloom_filter is not None:
+            ## the reads missing from the filter are certainly not associated, they stay UNDETERMINED
+            with self.instrumentation.timed("bloom screen"):
+                lookup_keys = self.bloom_filter.screen(list(keys))
+            self.instrumentation.count("bloom screened", len(keys))
+            self.instrumentation.count("bloom passed", len(lookup_keys))
+        lookup_source = self.read_index if self.read_index is not None else self.storage
+        id_sample_pairs = {}
+        if lookup_keys:
+            with self.instrumentation.timed("lookup"):
+                id_sample_pairs = lookup_source.get_multiple_read_sample_pairs(lookup_keys)
+        self.lookup_count += len(keys)
+        self.lookup_hit_count += len(id_sample_pairs)
+        if self.bloom_filter is not None:
+            ## a read passed the filter but not found among the reads it holds, e.g. a read of
+            ## a sample dropped by process still kept by the memory backends, is a false positive
+            true_positives = (len(id_sample_pairs) if self.selected_samples is None else
+                              sum(sample in self.selected_samples for sample in id_sample_pairs.values()))
+            self.instrumentation.count("bloom false positives", len(lookup_keys) - true_positives)
+        with self.instrumentation.timed("write and deflate"):
+            self._write_reads(reads_buffer, id_sample_pairs)
         reads_buffer.clear()
         
-    def _store(self, line, records):
+    def _store(self, read_id, cell_id, sample_name, records):
         """Read tags from the BAM file and puts them in the buffer"""
-        read_id, cell_id, sample_name = line.split()
         if sample_name == "x":
             ## UNDETERMINED case
             ## ignore
-            return
+            return(False)
         crid = crop_read_id(read_id)
         records.append((crid, cell_id, sample_name))
+        return(True)
     
@@ -6,10 +6,20 @@ __maintainer__ = "Jan Hapala"
 __email__ = "jan@hapala.cz"
 __status__ = "Production"
 
-import os
+import os, sys
+import glob
+import pickle
 import sqlite3
+from abc import ABC, abstractmethod
+from collections import defaultdict, Counter
 from datetime import datetime
+from time import perf_counter
+from operator import itemgetter
+from .stats import summarize_assignment
+from .sort_merge import write_run, read_run, merge_runs
 
+## rows fetched at once when a whole table is read
+ROWS_BATCH_SIZE = 100000
 
 class DatabaseException(Exception):
     pass
@@ -19,7 +29,96 @@ def get_timestamp():
     timestampStr = dateTimeObj.strftime("%Y-%m-%d_%H:%M:%S")
     return(timestampStr)
 
-class SQLReadStorage:
+def assign_cells_to_samples(cell_sample_counts, threshold):
+    """Return {cell ID: sample} with the dominant sample of every cell,
+        MULTIPLE if the dominant sample does not reach the threshold;
+        cell_sample_counts is {cell ID: {sample: abundance}}
+    """
+    cell_samples = {}
+    for cell_id, counts in cell_sample_counts.items():
+        sample, max_abd = max(counts.items(), key=itemgetter(1))
+        if max_abd >= sum(counts.values()) * threshold:
+            cell_samples[cell_id] = sample
+        else:
+            cell_samples[cell_id] = "MULTIPLE"
+    return(cell_samples)
+
+
+class ReadStorage(ABC):
+    """Common interface of the backends storing and retrieving
+        the read information; a backend missing any of the abstract
+        methods cannot be created.
+    """
+
+    instrumentation = None
+    ## False if the storage is used by a single command (split) and need not be saved
+    persistent = True
+    ## True if the reads are retrieved by a merge join instead of the lookups
+    sequential = False
+    ## True if the lookups are answered from the process memory, which the
+    ## retrieve worker processes share when it is loaded before they are forked
+    in_memory = False
+
+    def set_instrumentation(self, instrumentation):
+        """Record the time of the storage operations in the Instrumentation object."""
+        self.instrumentation = instrumentation
+
+    @abstractmethod
+    def setup(self):
+        """Prepare an empty storage for collecting read information."""
+
+    @abstractmethod
+    def store(self, records):
+        """Insert (read ID, cell ID, sample name) records, empty the list."""
+
+    @abstractmethod
+    def commit(self):
+        """Make the stored records persistent."""
+
+    @abstractmethod
+    def process_data(self, threshold, samples=None):
+        """Assign a sample to every cell and reads to samples; with a list
+            of samples, the reads of the other cells may be dropped.
+        """
+
+    @abstractmethod
+    def get_selected_samples(self):
+        """Return the samples selected by process, None if all were kept."""
+
+    @abstractmethod
+    def get_sample_summary(self):
+        """Return {sample: {"cells": count, "reads": count}} of the assigned cells."""
+
+    @abstractmethod
+    def get_cell_sample_counts(self):
+        """Return {cell ID: {sample: abundance}} kept for re-running the assignment."""
+
+    @abstractmethod
+    def cleanup(self):
+        """Drop everything but the read -- sample association."""
+
+    @abstractmethod
+    def get_multiple_read_sample_pairs(self, key_list):
+        """Return sample for read IDs provided in the argument"""
+
+    @abstractmethod
+    def iter_read_cells(self):
+        """Yield the (read ID, cell ID) pairs of the read -- cell association."""
+
+    @abstractmethod
+    def get_cell_samples(self):
+        """Return the {cell ID: sample} assignment of the cells."""
+
+    @abstractmethod
+    def close(self):
+        """Release the storage."""
+
+    @abstractmethod
+    def remove_db(self):
+        """Delete the storage file."""
+
+
+class SQLReadStorage(ReadStorage):
     """Interface for storing and retrieving the read information
         to/from the SQLite database.
     """
@@ -27,6 +126,7 @@ class SQLReadStorage:
     connection = None
     cursor = None
     db_file_name = None 
+    cell_samples = None
 
     def __init__(self, file_name):
         self.db_file_name = file_name
@@ -37,7 +137,8 @@ class SQLReadStorage:
         """
         if self.connection is None:
             try:
-                self.connection = sqlite3.connect(self.db_file_name)
+                ## the records may be stored from a writer thread, one thread at a time
+                self.connection = sqlite3.connect(self.db_file_name, check_same_thread=False)
                 #self.connection = apsw.Connection(self.db_file_name)
                 self.cursor = self.connection.cursor()
                 self.cursor.execute("PRAGMA synchronous = OFF;")
@@ -72,27 +173,75 @@ class SQLReadStorage:
         #self.cursor.execute("CREATE INDEX idx_sample_name ON reads(sample_name);")
         self.cursor.execute("CREATE INDEX idx_reads_cell_sample ON reads(cell_id, sample_name);")
 
-    def process_data(self, threshold):
-        """Calculate final association table from the initial read table."""
+    def process_data(self, threshold, samples=None):
+        """Calculate final association table from the initial read table.
+            The per-cell tallies and the read -- cell table are kept, so running
+            it again only re-assigns the cells at the new threshold.
+            With a list of samples, the association table keeps only the reads
+            of the cells assigned to them; it cannot be processed again then.
+        """
         self._init_connect()
-        print(f"{get_timestamp()}           * Calculating stats on cells")
-        self._calculate_stats_on_cells()
+        if self._table_exists("selected_samples"):
+            raise DatabaseException("The association table keeps only the reads of the samples selected before, "
+                                    "build the database again to re-run process.")
+        if self._table_exists("cells_stat"):
+            print(f"{get_timestamp()}           * Reusing the stats on cells")
+        else:
+            print(f"{get_timestamp()}           * Calculating stats on cells")
+            self._calculate_stats_on_cells()
         print(f"{get_timestamp()}           * Assigning cells to samples")
         self._assign_cells_to_samples(threshold)
-        print(f"{get_timestamp()}           * Creating the association table")
-        self._create_final_table()
+        print(f"{get_timestamp()}           * Creating the association table"
+              + (f" of the samples {', '.join(samples)}" if samples is not None else ""))
+        self._create_association(samples)
 
-    def get_total_cell_count(self):
-        """Return total number of putative cells."""
-        self.cursor.execute("SELECT COUNT(*) as count FROM cells;")
-        count = self.cursor.fetchone()
-        return(count[0])
+    def _create_association(self, samples=None):
+        """Create the final table unless it exists (from the previous run of process);
+            with a list of samples, only the reads of the cells assigned to them
+            are joined, or are kept in the existing table, and the selection is recorded
+        """
+        if not self._table_exists("read_cells"):
+            self._create_final_table(samples)
+        elif samples is not None:
+            self._restrict_final_table(samples)
+        if samples is not None:
+            try:
+                self.cursor.execute("CREATE TABLE selected_samples ( sample text NOT NULL );")
+                self.cursor.executemany("INSERT INTO selected_samples VALUES(?);", [(sample, ) for sample in samples])
+                self.connection.commit()
+            except Exception as e:
+                raise DatabaseException("Error while recording the selected samples.", e)
 
-    def get_cell_count_per_sample(self):
-        """Return cell count per sample tag."""
-        self.cursor.execute("SELECT sample, COUNT(*) as count FROM cells GROUP BY sample;")
-        counts = self.cursor.fetchall()
-        return(counts)
+    def _selected_cells(self, samples):
+        """Return the condition on the reads of the cells assigned to the samples and its parameters."""
+        return(f"cell_id IN (SELECT cell_id FROM cells WHERE sample IN ({','.join('?' * len(samples))}))",
+               list(samples))
+
+    def _restrict_final_table(self, samples):
+        """Delete the reads of the cells not assigned to the samples from the final table."""
+        condition, parameters = self._selected_cells(samples)
+        try:
+            self.cursor.execute(f"DELETE FROM read_cells WHERE NOT {condition};", parameters)
+            self.connection.commit()
+        except Exception as e:
+            raise DatabaseException("Error while restricting the association table to the selected samples.", e)
+
+    def get_selected_samples(self):
+        """Return the samples the final table was restricted to, None if it keeps all the reads."""
+        self._init_connect()
+        if not self._table_exists("selected_samples"):
+            return(None)
+        try:
+            self.cursor.execute("SELECT sample FROM selected_samples;")
+            return([sample for sample, in self.cursor.fetchall()])
+        except Exception as e:
+            raise DatabaseException("Error while retrieving data the database.", e)
+
+    def _table_exists(self, table):
+        """Return True if the table exists in the database."""
+        self._init_connect()
+        self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (table, ))
+        return(self.cursor.fetchone() is not None)
 
     def _calculate_stats_on_cells(self):
         """Calculate intermitten cells_stat table,
@@ -112,6 +261,7 @@ class SQLReadStorage:
             requires: cells_stat TABLE (self.calculate_stats_on_cells() )
         """
         try:
+            self.cursor.execute("DROP TABLE IF EXISTS cells;")
             query = f"""CREATE TABLE cells AS
                           SELECT  cell_id,
                             CASE
@@ -127,33 +277,118 @@ class SQLReadStorage:
         except Exception as e:
             raise DatabaseException("Error while calculating cell-sample relationships.", e)
 
+    def get_sample_summary(self):
+        """Return {sample: {"cells": count, "reads": count}} of the assigned cells,
+            from the small cells and cells_stat tables
+        """
+        return(self._get_sample_summary("""SELECT cells.sample, COUNT(DISTINCT cells.cell_id), SUM(abundance)
+                                            FROM cells JOIN cells_stat ON cells.cell_id = cells_stat.cell_id
+                                            GROUP BY cells.sample;"""))
+
+    def _get_sample_summary(self, query):
+        """Run the summary query returning (sample, cell count, read count) rows."""
+        self._init_connect()
+        try:
+            self.cursor.execute(query)
+            return({sample: {"cells": cells, "reads": reads} for sample, cells, reads in self.cursor.fetchall()})
+        except Exception as e:
+            raise DatabaseException("Error while retrieving data the database.", e)
+
+    def get_cell_sample_abundances(self):
+        """Return (cell ID, sample name, abundance) rows of the cells_stat table."""
+        self._init_connect()
+        try:
+            self.cursor.execute("SELECT cell_id, sample_name, abundance FROM cells_stat;")
+            return(self.cursor.fetchall())
+        except Exception as e:
+            raise DatabaseException("Error while retrieving data the database.", e)
+
+    def get_cell_sample_counts(self):
+        """Return {cell ID: {sample: abundance}} from the cells_stat table."""
+        cell_sample_counts = defaultdict(Counter)
+        for cell_id, sample_name, abundance in self.get_cell_sample_abundances():
+            cell_sample_counts[cell_id][sample_name] += abundance
+        return(cell_sample_counts)
+
+    def load_cell_assignments(self, cell_samples):
+        """Create the cells table from a {cell ID: sample} dict,
+            in place of _assign_cells_to_samples()
+        """
+        self._init_connect()
+        try:
+            self.cursor.execute("DROP TABLE IF EXISTS cells;")
+            self.cursor.execute("CREATE TABLE cells ( cell_id text NOT NULL, sample text NOT NULL );")
+            self.cursor.executemany("INSERT INTO cells VALUES(?,?);", cell_samples.items())
+            self.connection.commit()
+            self.cursor.execute("CREATE INDEX idx_cells_cell_id ON cells(cell_id);")
+            self.cursor.execute("CREATE INDEX idx_cells_sample_name ON cells(sample);")
+        except Exception as e:
+            raise DatabaseException("Error while calculating cell-sample relationships.", e)
+
     def cleanup(self):
-        """Delete all but the final table from the database."""
+        """Delete the initial read table; the small cells_stat and cells tables
+            are kept with the final table for re-running the assignment.
+        """
         self._init_connect()
         try:
             self.cursor.execute("DROP TABLE IF EXISTS reads;")
-            self.cursor.execute("DROP TABLE IF EXISTS cells;")
-            self.cursor.execute("DROP TABLE IF EXISTS cells_stat;")
         except Exception as e:
             raise DatabaseException("Error while deleting the database.", e)
 
-    def _create_final_table(self):
-        """Calculate the final association table."""
+    def _create_final_table(self, samples=None):
+        """Calculate the final read -- cell association table,
+            of the cells assigned to the samples if given.
+        """
         self._init_connect()
+        condition, parameters = self._selected_cells(samples) if samples is not None else ("1", [])
         try:
-            self.cursor.execute("""CREATE TABLE read_sample_pairs AS
-                                    SELECT read_id, sample FROM
-                                      (SELECT read_id, reads.cell_id, sample FROM reads
-                                        LEFT JOIN cells ON reads.cell_id = cells.cell_id);""")
+            self.cursor.execute(f"""CREATE TABLE read_cells AS
+                                    SELECT read_id, cell_id FROM reads WHERE {condition};""", parameters)
             ## create a covering index
-            self.cursor.execute("CREATE INDEX idx_pairs_cover ON read_sample_pairs(read_id, sample);")
+            self.cursor.execute("CREATE INDEX idx_read_cells_cover ON read_cells(read_id, cell_id);")
         except Exception as e:
             raise DatabaseException("Error while assigning the dominant sample to cell IDs.", e)
 
+    def _load_cell_samples(self):
+        """Load the (small) cell -- sample assignment from the cells table."""
+        if self.cell_samples is None:
+            self._init_connect()
+            try:
+                self.cursor.execute("SELECT cell_id, sample FROM cells;")
+                self.cell_samples = dict(self.cursor.fetchall())
+            except Exception as e:
+                raise DatabaseException("Error while retrieving data the database.", e)
+
     def get_multiple_read_sample_pairs(self, key_list):
         """Return sample for read IDs provided in the argument"""
+        self._load_cell_samples()
+        cell_samples = self.cell_samples
+        read_cells = self.get_multiple("read_cells", ["read_id", "cell_id"], "read_id", key_list)
+        return({read_id: cell_samples[cell_id] for read_id, cell_id in read_cells.items()})
+
+    def iter_read_cells(self):
+        """Yield the (read ID, cell ID) pairs of the final table."""
+        yield from self._iter_rows("SELECT read_id, cell_id FROM read_cells;")
+
+    def _iter_rows(self, query):
+        """Yield the rows of the query in batches, on a cursor of its own."""
         self._init_connect()
-        return self.get_multiple("read_sample_pairs", ["read_id", "sample"], "read_id", key_list)
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query)
+            rows = cursor.fetchmany(ROWS_BATCH_SIZE)
+            while rows:
+                yield from rows
+                rows = cursor.fetchmany(ROWS_BATCH_SIZE)
+        except Exception as e:
+            raise DatabaseException("Error while retrieving data the database.", e)
+        finally:
+            cursor.close()
+
+    def get_cell_samples(self):
+        """Return the {cell ID: sample} assignment from the cells table."""
+        self._load_cell_samples()
+        return(dict(self.cell_samples))
 
     def get_multiple(self, table, field_list, lookup_field, key_list):
         """generic method for retrieving information form the database."""
@@ -164,12 +399,16 @@ class SQLReadStorage:
         key_list = list(key_list)
         
         result = None
+        start = perf_counter()
         try:
             self.cursor.execute(f"""SELECT {fields_string} FROM {table} 
                                     WHERE {lookup_field} IN ({keys_string});""", key_list)
             result = dict(self.cursor.fetchall())
         except Exception as e:
             raise DatabaseException("Error while retrieving data the database.", e)
+        if self.instrumentation is not None:
+            self.instrumentation.add_time("sql query", perf_counter() - start)
+            self.instrumentation.count("sql keys", len(key_list))
 
         return(result)
 
@@ -184,7 +423,7 @@ class SQLReadStorage:
     def commit(self):
         """Commit the changes to the database."""
         try:
-            self.cursor.execute("COMMIT;")
+            self.connection.commit()
         except Exception as e:
             raise DatabaseException("Error while committing changes to the database.", e)
 
@@ -195,9 +434,618 @@ class SQLReadStorage:
                 self.connection.close()
             except Exception as e:
                 raise DatabaseException("Error while closing connection to the database.", e)
+            self.connection, self.cursor = None, None
         
     def remove_db(self):
         """Delete the database file."""
         self.close()
         os.remove(self.db_file_name)
 
+
+
+## bit widths of the Illumina read coordinates packed into an integer read key
+LANE_BITS = 4
+TILE_BITS = 17
+X_BITS = 21
+Y_BITS = 21
+MULTIPLE_SAMPLE_CODE = 0
+
+
+class ReadKeyCodec:
+    """Packs cropped Illumina read IDs (flowcell:lane:tile:x:y) of one
+        flowcell into 63-bit integers; other IDs, also those with zero-padded
+        coordinates, are not packed, so unpack() restores the ID exactly.
+    """
+
+    flowcell = None
+
+    def __init__(self, flowcell = None):
+        self.flowcell = flowcell
+
+    def pack(self, read_id):
+        """Return the integer key of the read ID, None if it cannot be packed"""
+        fields = read_id.split(":")
+        if len(fields) != 5:
+            return(None)
+        flowcell, lane, tile, x, y = fields
+        if self.flowcell is None:
+            self.flowcell = flowcell
+        elif flowcell != self.flowcell:
+            return(None)
+        coordinates = (lane, tile, x, y)
+        try:
+            lane, tile, x, y = int(lane), int(tile), int(x), int(y)
+        except ValueError:
+            return(None)
+        ## zero-padded (or signed) coordinates would not be restored by unpack()
+        if coordinates != (str(lane), str(tile), str(x), str(y)):
+            return(None)
+        if (lane >> LANE_BITS or tile >> TILE_BITS or x >> X_BITS or y >> Y_BITS
+                or min(lane, tile, x, y) < 0):
+            return(None)
+        return((((lane << TILE_BITS | tile) << X_BITS | x) << Y_BITS) | y)
+
+    def unpack(self, read_key):
+        """Return the read ID packed into the integer key"""
+        y = read_key & ((1 << Y_BITS) - 1)
+        read_key >>= Y_BITS
+        x = read_key & ((1 << X_BITS) - 1)
+        read_key >>= X_BITS
+        tile = read_key & ((1 << TILE_BITS) - 1)
+        return(f"{self.flowcell}:{read_key >> TILE_BITS}:{tile}:{x}:{y}")
+
+
+class CompactSQLReadStorage(SQLReadStorage):
+    """SQLite database with dictionary-encoded samples and cells;
+        the read IDs are stored as integers packed from the read
+        coordinates, the string IDs are kept only if they cannot be packed.
+    """
+
+    cell_codes = None
+    sample_codes = None
+    sample_names = None
+    codec = None
+
+    def setup(self):
+        """Create the tables for collecting read information
+            from the BAM file.
+        """
+        if os.path.exists(self.db_file_name):
+            os.remove(self.db_file_name)
+
+        self._init_connect()
+        try:
+            self.cursor.execute("""CREATE TABLE reads ( read_key integer,
+                                                        read_id text,
+                                                        cell_code integer NOT NULL,
+                                                        sample_code integer NOT NULL )
+                                                         ;""")
+            self.cursor.execute("CREATE TABLE cell_codes ( code integer PRIMARY KEY, cell_id text NOT NULL );")
+            self.cursor.execute("CREATE TABLE sample_codes ( code integer PRIMARY KEY, sample_name text NOT NULL );")
+            self.cursor.execute("CREATE TABLE meta ( key text PRIMARY KEY, value text );")
+        except Exception as e:
+            raise DatabaseException("Error while initializing the database.", e)
+        self.cell_codes = {}
+        self.sample_codes = {"MULTIPLE": MULTIPLE_SAMPLE_CODE}
+        self.codec = ReadKeyCodec()
+
+    def store(self, records):
+        """Encode the read information and insert it into the database."""
+        cell_codes, sample_codes, pack = self.cell_codes, self.sample_codes, self.codec.pack
+        encoded = []
+        for read_id, cell_id, sample_name in records:
+            cell_code = cell_codes.setdefault(cell_id, len(cell_codes))
+            sample_code = sample_codes.setdefault(sample_name, len(sample_codes))
+            read_key = pack(read_id)
+            encoded.append((read_key, None if read_key is not None else read_id, cell_code, sample_code))
+        try:
+            self.cursor.executemany('INSERT INTO reads VALUES(?,?,?,?);', encoded);
+        except Exception as e:
+            raise DatabaseException("Error while inserting into the database.", e)
+        records.clear()
+
+    def commit(self):
+        """Save the dictionaries and commit the changes to the database."""
+        try:
+            self.cursor.executemany("INSERT INTO cell_codes VALUES(?,?);",
+                                    [(code, cell_id) for cell_id, code in self.cell_codes.items()])
+            self.cursor.executemany("INSERT INTO sample_codes VALUES(?,?);",
+                                    [(code, name) for name, code in self.sample_codes.items()])
+            self.cursor.execute("INSERT INTO meta VALUES('flowcell', ?);", (self.codec.flowcell, ))
+        except Exception as e:
+            raise DatabaseException("Error while inserting into the database.", e)
+        super().commit()
+
+    def _load_dictionaries(self):
+        """Load the sample names and the read key codec from the database."""
+        if self.sample_names is None:
+            self._init_connect()
+            try:
+                self.cursor.execute("SELECT code, sample_name FROM sample_codes;")
+                self.sample_names = dict(self.cursor.fetchall())
+                self.cursor.execute("SELECT value FROM meta WHERE key = 'flowcell';")
+                row = self.cursor.fetchone()
+            except Exception as e:
+                raise DatabaseException("Error while retrieving data the database.", e)
+            ## the codec must not pick up a new flowcell while looking up
+            self.codec = ReadKeyCodec(row[0] if row is not None and row[0] is not None else "")
+
+    def _calculate_stats_on_cells(self):
+        """Calculate intermitten cells_stat table,
+            requires: reads TABLE filled with all values (self.store() )
+        """
+        try:
+            self.cursor.execute("""CREATE TABLE cells_stat AS 
+                                SELECT cell_code, sample_code, COUNT(*) abundance 
+                                FROM reads GROUP BY cell_code, sample_code;""")
+            self.cursor.execute("CREATE INDEX idx_stat_cell_code ON cells_stat(cell_code);")
+        except Exception as e:
+            raise DatabaseException("Error while calculating statistics on cell IDs.", e)
+
+    def _assign_cells_to_samples(self, threshold = 0.75):
+        """Create an intermitten table cells,
+            requires: cells_stat TABLE (self.calculate_stats_on_cells() )
+        """
+        try:
+            self.cursor.execute("DROP TABLE IF EXISTS cells;")
+            query = f"""CREATE TABLE cells AS
+                          SELECT  cell_code,
+                            CASE
+                              WHEN max_abd >= sum_abd*{threshold} THEN sample_code
+                                  ELSE {MULTIPLE_SAMPLE_CODE}
+                              END sample_code FROM
+                                (SELECT cell_code, sample_code,
+                                     MAX(abundance) max_abd, SUM(abundance) sum_abd
+                                         FROM cells_stat GROUP BY cell_code);"""
+            self.cursor.execute(query)
+            self.cursor.execute("CREATE UNIQUE INDEX idx_cells_cell_code ON cells(cell_code);")
+        except Exception as e:
+            raise DatabaseException("Error while calculating cell-sample relationships.", e)
+
+    def get_sample_summary(self):
+        """Return {sample: {"cells": count, "reads": count}} of the assigned cells,
+            from the small cells and cells_stat tables
+        """
+        return(self._get_sample_summary("""SELECT sample_name, COUNT(DISTINCT cells.cell_code), SUM(abundance)
+                                            FROM cells JOIN cells_stat ON cells.cell_code = cells_stat.cell_code
+                                            JOIN sample_codes ON cells.sample_code = sample_codes.code
+                                            GROUP BY sample_name;"""))
+
+    def get_cell_sample_abundances(self):
+        """Return (cell ID, sample name, abundance) rows of the cells_stat table."""
+        self._init_connect()
+        try:
+            self.cursor.execute("""SELECT cell_id, sample_name, abundance FROM cells_stat
+                                    JOIN cell_codes ON cells_stat.cell_code = cell_codes.code
+                                    JOIN sample_codes ON cells_stat.sample_code = sample_codes.code;""")
+            return(self.cursor.fetchall())
+        except Exception as e:
+            raise DatabaseException("Error while retrieving data the database.", e)
+
+    def load_cell_assignments(self, cell_samples):
+        """Create the cells table from a {cell ID: sample} dict,
+            in place of _assign_cells_to_samples(); only the cells
+            present in this database are loaded
+        """
+        self._init_connect()
+        try:
+            self.cursor.execute("SELECT cell_id, code FROM cell_codes;")
+            cell_codes = dict(self.cursor.fetchall())
+            self.cursor.execute("SELECT sample_name, code FROM sample_codes;")
+            sample_codes = dict(self.cursor.fetchall())
+            ## samples assigned to cells whose reads of that sample are all in other databases
+            new_samples = set(cell_samples.values()) - set(sample_codes)
+            next_code = max(sample_codes.values(), default=MULTIPLE_SAMPLE_CODE) + 1
+            for code, sample_name in enumerate(sorted(new_samples), next_code):
+                sample_codes[sample_name] = code
+                self.cursor.execute("INSERT INTO sample_codes VALUES(?,?);", (code, sample_name))
+            self.cursor.execute("DROP TABLE IF EXISTS cells;")
+            self.cursor.execute("CREATE TABLE cells ( cell_code integer NOT NULL, sample_code integer NOT NULL );")
+            self.cursor.executemany("INSERT INTO cells VALUES(?,?);",
+                                    [(cell_codes[cell_id], sample_codes[sample])
+                                     for cell_id, sample in cell_samples.items() if cell_id in cell_codes])
+            self.connection.commit()
+            self.cursor.execute("CREATE UNIQUE INDEX idx_cells_cell_code ON cells(cell_code);")
+        except Exception as e:
+            raise DatabaseException("Error while calculating cell-sample relationships.", e)
+
+    def _selected_cells(self, samples):
+        """Return the condition on the reads of the cells assigned to the samples and its parameters."""
+        return(f"""cell_code IN (SELECT cell_code FROM cells
+                                   JOIN sample_codes ON cells.sample_code = sample_codes.code
+                                   WHERE sample_name IN ({','.join('?' * len(samples))}))""",
+               list(samples))
+
+    def _restrict_final_table(self, samples):
+        """Delete the reads of the cells not assigned to the samples from the final tables."""
+        condition, parameters = self._selected_cells(samples)
+        try:
+            self.cursor.execute(f"DELETE FROM read_cells WHERE NOT {condition};", parameters)
+            self.cursor.execute(f"DELETE FROM read_cells_text WHERE NOT {condition};", parameters)
+            self.connection.commit()
+        except Exception as e:
+            raise DatabaseException("Error while restricting the association table to the selected samples.", e)
+
+    def _create_final_table(self, samples=None):
+        """Calculate the final read -- cell association tables, keyed on the packed
+            read keys and on the read IDs which could not be packed;
+            of the cells assigned to the samples if given.
+        """
+        self._init_connect()
+        condition, parameters = self._selected_cells(samples) if samples is not None else ("1", [])
+        try:
+            self.cursor.execute("""CREATE TABLE read_cells ( read_key integer PRIMARY KEY,
+                                                             cell_code integer )
+                                                             WITHOUT ROWID;""")
+            self.cursor.execute(f"""INSERT OR IGNORE INTO read_cells
+                                    SELECT read_key, cell_code FROM reads
+                                      WHERE read_key IS NOT NULL AND {condition} ORDER BY read_key;""", parameters)
+            self.cursor.execute("""CREATE TABLE read_cells_text ( read_id text PRIMARY KEY,
+                                                                  cell_code integer )
+                                                                  WITHOUT ROWID;""")
+            self.cursor.execute(f"""INSERT OR IGNORE INTO read_cells_text
+                                    SELECT read_id, cell_code FROM reads
+                                      WHERE read_key IS NULL AND {condition} ORDER BY read_id;""", parameters)
+            self.connection.commit()
+        except Exception as e:
+            raise DatabaseException("Error while assigning the dominant sample to cell IDs.", e)
+
+    def _load_cell_samples(self):
+        """Load the (small) cell code -- sample name assignment from the cells table."""
+        if self.cell_samples is None:
+            self._load_dictionaries()
+            try:
+                self.cursor.execute("SELECT cell_code, sample_code FROM cells;")
+                sample_names = self.sample_names
+                self.cell_samples = {cell_code: sample_names[sample_code]
+                                     for cell_code, sample_code in self.cursor.fetchall()}
+            except Exception as e:
+                raise DatabaseException("Error while retrieving data the database.", e)
+
+    def get_multiple_read_sample_pairs(self, key_list):
+        """Return sample for read IDs provided in the argument"""
+        self._load_cell_samples()
+        read_ids_by_key = {}
+        unpacked = []
+        for read_id in key_list:
+            read_key = self.codec.pack(read_id)
+            if read_key is None:
+                unpacked.append(read_id)
+            else:
+                read_ids_by_key[read_key] = read_id
+        cell_samples = self.cell_samples
+        result = {}
+        if read_ids_by_key:
+            pairs = self.get_multiple("read_cells", ["read_key", "cell_code"], "read_key", read_ids_by_key)
+            result.update((read_ids_by_key[read_key], cell_samples[code]) for read_key, code in pairs.items())
+        if unpacked:
+            pairs = self.get_multiple("read_cells_text", ["read_id", "cell_code"], "read_id", unpacked)
+            result.update((read_id, cell_samples[code]) for read_id, code in pairs.items())
+        return(result)
+
+    def _load_cell_ids(self):
+        """Return the {cell code: cell ID} dictionary."""
+        self._init_connect()
+        try:
+            self.cursor.execute("SELECT code, cell_id FROM cell_codes;")
+            return(dict(self.cursor.fetchall()))
+        except Exception as e:
+            raise DatabaseException("Error while retrieving data the database.", e)
+
+    def iter_read_cells(self):
+        """Yield the (read ID, cell ID) pairs of the final tables,
+            the packed read keys are unpacked
+        """
+        self._load_dictionaries()
+        cell_ids = self._load_cell_ids()
+        unpack = self.codec.unpack
+        for read_key, cell_code in self._iter_rows("SELECT read_key, cell_code FROM read_cells;"):
+            yield(unpack(read_key), cell_ids[cell_code])
+        for read_id, cell_code in self._iter_rows("SELECT read_id, cell_code FROM read_cells_text;"):
+            yield(read_id, cell_ids[cell_code])
+
+    def get_cell_samples(self):
+        """Return the {cell ID: sample} assignment from the cells table."""
+        self._load_cell_samples()
+        cell_ids = self._load_cell_ids()
+        return({cell_ids[cell_code]: sample for cell_code, sample in self.cell_samples.items()})
+
+
+class MemoryReadStorage(ReadStorage):
+    """Keeps the read information in hash maps, cell abundances per sample
+        are counted while the records are stored. Between the commands
+        the read map is pickled into the database file and the cell maps
+        into a small file next to it (database file + ".cells"), so that
+        process saves and loads just the cell maps; neither is saved if
+        the storage is not persistent.
+    """
+
+    db_file_name = None
+    cells_file_name = None
+    read_cells = None
+    cell_sample_counts = None
+    cell_samples = None
+    selected_samples = None
+    ## the cell maps and the read map changed since they were saved
+    dirty = False
+    reads_dirty = False
+    in_memory = True
+
+    def __init__(self, file_name):
+        self.db_file_name = file_name
+        self.cells_file_name = file_name + ".cells"
+
+    def _load(self):
+        """Load the cell maps saved by the previous command."""
+        if self.cell_sample_counts is None:
+            try:
+                with open(self.cells_file_name, "rb") as f:
+                    data = pickle.load(f)
+            except Exception as e:
+                raise DatabaseException("Error while loading the in-memory database.", e)
+            self.cell_sample_counts = data["cell_sample_counts"]
+            self.cell_samples = data["cell_samples"]
+            self.selected_samples = data.get("selected_samples")
+
+    def _load_reads(self):
+        """Load the read map saved by the build command, only retrieve needs it."""
+        self._load()
+        if self.read_cells is None:
+            try:
+                with open(self.db_file_name, "rb") as f:
+                    self.read_cells = pickle.load(f)
+            except Exception as e:
+                raise DatabaseException("Error while loading the in-memory database.", e)
+
+    def load(self):
+        """Load all the maps now, before forking the retrieve worker processes."""
+        self._load_reads()
+
+    def setup(self):
+        """Start with empty maps."""
+        if self.persistent:
+            self.remove_db()
+        self.read_cells = {}
+        self.cell_sample_counts = defaultdict(Counter)
+        self.cell_samples = {}
+        self.selected_samples = None
+        self.dirty = self.reads_dirty = True
+
+    def store(self, records):
+        """Map read IDs to cells and count the sample tags of each cell."""
+        read_cells = self.read_cells
+        cell_sample_counts = self.cell_sample_counts
+        intern = sys.intern
+        for read_id, cell_id, sample_name in records:
+            cell_id = intern(cell_id)
+            read_cells[read_id] = cell_id
+            cell_sample_counts[cell_id][intern(sample_name)] += 1
+        self.dirty = self.reads_dirty = True
+        records.clear()
+
+    def commit(self):
+        """Save the changed maps into the database file and the cells file."""
+        if not self.persistent:
+            return
+        try:
+            if self.reads_dirty:
+                with open(self.db_file_name, "wb") as f:
+                    pickle.dump(self.read_cells, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if self.dirty:
+                with open(self.cells_file_name, "wb") as f:
+                    pickle.dump({"cell_sample_counts": dict(self.cell_sample_counts),
+                                 "cell_samples": self.cell_samples,
+                                 "selected_samples": self.selected_samples},
+                                f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            raise DatabaseException("Error while saving the in-memory database.", e)
+        self.dirty = self.reads_dirty = False
+
+    def process_data(self, threshold, samples=None):
+        """Assign the dominant sample to every cell, MULTIPLE if the dominant
+            sample does not reach the threshold. The read map is kept whole,
+            a selection of samples is only recorded for retrieve.
+        """
+        self._load()
+        print(f"{get_timestamp()}           * Assigning cells to samples")
+        self.cell_samples = assign_cells_to_samples(self.cell_sample_counts, threshold)
+        self.selected_samples = samples
+        self.dirty = True
+
+    def get_selected_samples(self):
+        """Return the samples selected by process, None if all were kept."""
+        self._load()
+        return(self.selected_samples)
+
+    def get_sample_summary(self):
+        """Return {sample: {"cells": count, "reads": count}} of the assigned cells."""
+        self._load()
+        return(summarize_assignment(self.cell_sample_counts, self.cell_samples))
+
+    def get_cell_sample_counts(self):
+        """Return {cell ID: {sample: abundance}} counted while storing."""
+        self._load()
+        return(self.cell_sample_counts)
+
+    def cleanup(self):
+        """Keep everything, the per cell abundances are small and allow
+            re-running the assignment.
+        """
+        self._load()
+
+    def get_multiple_read_sample_pairs(self, key_list):
+        """Return sample for read IDs provided in the argument"""
+        self._load_reads()
+        read_cells, cell_samples = self.read_cells, self.cell_samples
+        result = {}
+        for key in key_list:
+            cell_id = read_cells.get(key)
+            if cell_id is not None:
+                result[key] = cell_samples.get(cell_id)
+        return(result)
+
+    def iter_read_cells(self):
+        """Yield the (read ID, cell ID) pairs of the read map."""
+        self._load_reads()
+        return(iter(self.read_cells.items()))
+
+    def get_cell_samples(self):
+        """Return the {cell ID: sample} assignment."""
+        self._load()
+        return(self.cell_samples)
+
+    def close(self):
+        """Save the maps if they were changed."""
+        if (self.dirty or self.reads_dirty) and self.persistent:
+            self.commit()
+
+    def remove_db(self):
+        """Delete the database file and the cells file."""
+        self.dirty = self.reads_dirty = False
+        if self.persistent:
+            for file_name in (self.db_file_name, self.cells_file_name):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+
+class SortedRunStorage(MemoryReadStorage):
+    """Keeps the read information in files which are only written and read
+        sequentially, for inputs outgrowing the memory and the SQLite indexes:
+        every batch is sorted by the read ID and spilled into a run file,
+        process merges the runs into one sorted read -- cell association file,
+        counting the sample tags of the cells on the way, and retrieve
+        merge-joins it with the sorted read IDs of the FASTQ files.
+        The cell counts and assignment are pickled into the database file.
+    """
+
+    sequential = True
+    in_memory = False
+    runs = None
+    association_file_name = None
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        self.association_file_name = file_name + ".assoc"
+
+    def _load(self):
+        """Load the run list and the cell maps saved by the previous command."""
+        if self.runs is None:
+            try:
+                with open(self.db_file_name, "rb") as f:
+                    data = pickle.load(f)
+            except Exception as e:
+                raise DatabaseException("Error while loading the sorted run database.", e)
+            self.runs = data["runs"]
+            self.cell_sample_counts = data["cell_sample_counts"]
+            self.cell_samples = data["cell_samples"]
+            self.selected_samples = data.get("selected_samples")
+
+    def setup(self):
+        """Start with no runs, delete the files of a previous database."""
+        self.remove_db()
+        self.runs = []
+        self.cell_sample_counts = defaultdict(Counter)
+        self.cell_samples = {}
+        self.selected_samples = None
+        self.dirty = True
+
+    def store(self, records):
+        """Sort the records by the read ID and spill them into a new run file."""
+        records.sort(key=itemgetter(0))
+        self.runs.append(write_run(f"{self.db_file_name}.run{len(self.runs)}", records))
+        self.dirty = True
+        records.clear()
+
+    def commit(self):
+        """Save the run list and the cell maps into the database file."""
+        if not self.persistent:
+            return
+        try:
+            with open(self.db_file_name, "wb") as f:
+                pickle.dump({"runs": self.runs,
+                             "cell_sample_counts": dict(self.cell_sample_counts),
+                             "cell_samples": self.cell_samples,
+                             "selected_samples": self.selected_samples},
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            raise DatabaseException("Error while saving the sorted run database.", e)
+        self.dirty = False
+
+    def process_data(self, threshold, samples=None):
+        """Merge the runs into the association file (once, it does not depend on
+            the threshold) and assign the dominant sample to every cell;
+            a selection of samples is only recorded, retrieve joins just their reads.
+        """
+        self._load()
+        if not os.path.exists(self.association_file_name) or not self.cell_sample_counts:
+            print(f"{get_timestamp()}           * Merging {len(self.runs)} sorted runs")
+            self._merge_runs()
+        print(f"{get_timestamp()}           * Assigning cells to samples")
+        self.cell_samples = assign_cells_to_samples(self.cell_sample_counts, threshold)
+        self.selected_samples = samples
+        self.dirty = True
+
+    def _merge_runs(self):
+        """Write the association file keeping the first cell of every read ID,
+            count the sample tags per cell from all the records
+        """
+        cell_sample_counts = defaultdict(Counter)
+        temp_file_name = self.association_file_name + ".tmp"
+        try:
+            write_run(temp_file_name, self._unique_read_cells(merge_runs(self.runs, self.db_file_name + ".merge"),
+                                                              cell_sample_counts))
+        except OSError as e:
+            raise DatabaseException("Error while merging the sorted runs.", e)
+        os.replace(temp_file_name, self.association_file_name)
+        self.cell_sample_counts = cell_sample_counts
+        self.dirty = True
+
+    @staticmethod
+    def _unique_read_cells(rows, cell_sample_counts):
+        """Yield (read ID, cell ID) of the first of the merged records of every read ID"""
+        previous_read_id = None
+        intern = sys.intern
+        for read_id, cell_id, sample_name in rows:
+            cell_sample_counts[intern(cell_id)][intern(sample_name)] += 1
+            if read_id != previous_read_id:
+                previous_read_id = read_id
+                yield(read_id, cell_id)
+
+    def cleanup(self):
+        """Delete the run files, the association file and the cell maps are kept."""
+        self._load()
+        for run in self.runs:
+            if os.path.exists(run):
+                os.remove(run)
+        self.runs = []
+        self.dirty = True
+
+    def get_multiple_read_sample_pairs(self, key_list):
+        """The reads are retrieved by a merge join with iter_read_cells()"""
+        raise DatabaseException("The sorted run database cannot be looked up, it is read by a merge join.")
+
+    def iter_read_cells(self):
+        """Yield the (read ID, cell ID) pairs of the association file, sorted by the read ID."""
+        self._load()
+        return(read_run(self.association_file_name))
+
+    def remove_db(self):
+        """Delete the database file, the run files and the association file."""
+        self.dirty = False
+        for file_name in ([self.db_file_name, self.association_file_name]
+                          + glob.glob(glob.escape(self.db_file_name) + ".run*")):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+
+STORAGE_BACKENDS = {"sqlite": SQLReadStorage,
+                    "sqlite-compact": CompactSQLReadStorage,
+                    "memory": MemoryReadStorage,
+                    "sorted": SortedRunStorage}
+
+
+def get_storage(backend, file_name):
+    """Return a storage instance of the backend named in the argument."""
+    if backend not in STORAGE_BACKENDS:
+        raise DatabaseException(f"Unknown storage backend: {backend}")
+    return STORAGE_BACKENDS[backend](file_name)
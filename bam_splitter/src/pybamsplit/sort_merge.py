@@ -0,0 +1,105 @@
+"""sort_merge.py: sorted run files on disk, their external merge and the merge join"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import os
+import gzip
+import heapq
+from operator import itemgetter
+
+## rows sorted in memory before they are spilled into a run file
+RUN_SIZE = 1000000
+## run files merged at once, more are merged in several passes
+MERGE_FAN_IN = 64
+## the runs are written once and read once, fast compression saves the scratch disk
+RUN_COMPRESSION_LEVEL = 1
+
+
+def write_run(file_name, rows):
+    """Write the rows (tuples of str or int fields) into a run file, one tab-separated line each"""
+    with gzip.open(file_name, "wt", compresslevel=RUN_COMPRESSION_LEVEL) as f:
+        f.writelines("\t".join(map(str, row)) + "\n" for row in rows)
+    return(file_name)
+
+
+def read_run(file_name):
+    """Yield the rows of the run file as lists of str fields"""
+    with gzip.open(file_name, "rt") as f:
+        for line in f:
+            yield(line.rstrip("\n").split("\t"))
+
+
+def merge_runs(file_names, temp_prefix, key=itemgetter(0), fan_in=MERGE_FAN_IN):
+    """Yield the rows of the sorted run files merged by the key; rows with
+        equal keys keep the order of the files. With more than fan_in files,
+        groups of them are merged into intermediate runs first
+        (temp_prefix + a number), which are deleted when the merge finishes.
+    """
+    file_names = list(file_names)
+    temp_files = []
+    try:
+        while len(file_names) > fan_in:
+            merged = []
+            for start in range(0, len(file_names), fan_in):
+                temp_file = f"{temp_prefix}{len(temp_files)}"
+                temp_files.append(temp_file)
+                write_run(temp_file, heapq.merge(*map(read_run, file_names[start:start + fan_in]), key=key))
+                merged.append(temp_file)
+            file_names = merged
+        yield from heapq.merge(*map(read_run, file_names), key=key)
+    finally:
+        for temp_file in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+
+def merge_join(rows, table_rows):
+    """Yield (row, table row) for the rows whose first field is found in the table;
+        both are sorted by the first field, the table has unique keys
+    """
+    table_rows = iter(table_rows)
+    table_row = next(table_rows, None)
+    for row in rows:
+        key = row[0]
+        while table_row is not None and table_row[0] < key:
+            table_row = next(table_rows, None)
+        if table_row is None:
+            return
+        if table_row[0] == key:
+            yield(row, table_row)
+
+
+class MergedReadSamples:
+    """Gives the samples of consecutive batches of reads, in the input order,
+        from the merge join results (record number, read ID, sample) sorted
+        by the record number; used in place of the storage lookups.
+    """
+
+    rows = None
+    next_row = None
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.next_row = next(self.rows, None)
+
+    def get_multiple_read_sample_pairs(self, key_list):
+        """Return sample for read IDs provided in the argument, which must
+            be the next reads of the input (a dict view or a set)
+        """
+        result = {}
+        row = self.next_row
+        while row is not None and row[1] in key_list:
+            result[row[1]] = row[2]
+            row = next(self.rows, None)
+        self.next_row = row
+        return(result)
+
+    def close(self):
+        """Stop reading the join results"""
+        if hasattr(self.rows, "close"):
+            self.rows.close()
+        self.rows, self.next_row = iter(()), None
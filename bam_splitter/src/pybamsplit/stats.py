@@ -0,0 +1,82 @@
+"""stats.py: machine-readable summary of the statistics collected during the run"""
+
+__author__ = "Jan Hapala"
+__version__ = "1.0.0"
+__maintainer__ = "Jan Hapala"
+__email__ = "jan@hapala.cz"
+__status__ = "Production"
+
+import os
+import json
+from operator import itemgetter
+
+STATS_FILE_NAME = "fqsplit_stats.json"
+
+
+def summarize_assignment(cell_sample_counts, cell_samples):
+    """Return {sample: {"cells": count, "reads": count}} of the assigned cells;
+        cell_sample_counts is {cell ID: {sample: abundance}},
+        cell_samples is {cell ID: assigned sample}
+    """
+    summary = {}
+    for cell_id, sample in cell_samples.items():
+        sample_summary = summary.setdefault(sample, {"cells": 0, "reads": 0})
+        sample_summary["cells"] += 1
+        sample_summary["reads"] += sum(cell_sample_counts.get(cell_id, {}).values())
+    return(summary)
+
+
+def sweep_thresholds(cell_sample_counts, thresholds):
+    """Return {threshold: {sample: cell count}} of the cell assignment at every threshold,
+        the cells not reaching the threshold are counted as MULTIPLE;
+        the dominant sample and the total of every cell are found only once
+    """
+    dominant = []
+    for counts in cell_sample_counts.values():
+        sample, max_abd = max(counts.items(), key=itemgetter(1))
+        dominant.append((sample, max_abd, sum(counts.values())))
+    sweep = {}
+    for threshold in thresholds:
+        cells = {}
+        for sample, max_abd, sum_abd in dominant:
+            if max_abd < sum_abd * threshold:
+                sample = "MULTIPLE"
+            cells[sample] = cells.get(sample, 0) + 1
+        sweep[threshold] = cells
+    return(sweep)
+
+
+class RunStats:
+    """JSON file in the output directory, every command saves its own section"""
+
+    file_name = None
+
+    def __init__(self, out_dir):
+        if out_dir is not None:
+            self.file_name = os.path.join(out_dir, STATS_FILE_NAME)
+
+    def load(self):
+        """Return the sections saved so far"""
+        if self.file_name is None or not os.path.exists(self.file_name):
+            return({})
+        with open(self.file_name) as f:
+            return(json.load(f))
+
+    def save(self, section, values):
+        """Save the section, keeping the sections of the other commands;
+            the statistics are only informative, a failed write is reported
+            and does not stop the command
+        """
+        if self.file_name is None:
+            return
+        try:
+            data = self.load()
+            data[section] = values
+            temp_file_name = self.file_name + ".tmp"
+            with open(temp_file_name, "w") as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(temp_file_name, self.file_name)
+        except (OSError, ValueError) as e:
+            ## read_storage imports this module
+            from .read_storage import get_timestamp
+            print(f"{get_timestamp()}    Warning: cannot save the statistics to {self.file_name}: {e}", flush=True)